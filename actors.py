@@ -0,0 +1,73 @@
+from base64 import urlsafe_b64decode
+from collections import OrderedDict
+from json import loads
+from time import monotonic, time
+from typing import Any, Optional
+
+def token_expiry(token: str) -> Optional[float]:
+  """Returns the exp claim of the JWT in an Authorization header, None when it has none
+
+  The signature isn't checked here, the token is only cached once it has been verified"""
+  try:
+    payload = token.split()[-1].split(".")[1]
+    exp = loads(urlsafe_b64decode(payload + "=" * (-len(payload) % 4))).get("exp")
+    return float(exp) if exp is not None else None
+  except (IndexError, ValueError, TypeError, AttributeError):
+    return None
+
+class ActorCache:
+  """Process wide LRU cache of the actors resolved from the auth tokens
+
+  Entries live until ttl or the token's exp, whichever comes first. invalidate only reaches this process, so another worker's changes to an actor are seen after at most ttl seconds"""
+  def __init__(self, max_size: int = 1024, ttl: float = 60.0):
+    self.max_size = max_size
+    self.ttl = ttl
+
+    self._entries = OrderedDict()
+    self._subjects = {}
+
+  def configure(self, config):
+    self.max_size = config.get("ACTOR_CACHE_SIZE", self.max_size)
+    self.ttl = config.get("ACTOR_CACHE_TTL", self.ttl)
+
+  def get(self, token: str) -> Optional[Any]:
+    entry = self._entries.get(token)
+    if entry is None:
+      return None
+
+    expires, exp, actor = entry
+    if expires < monotonic() or (exp is not None and exp <= time()):
+      self._discard(token)
+      return None
+
+    self._entries.move_to_end(token)
+    return actor
+
+  def set(self, token: str, actor: Any):
+    self._discard(token)
+    self._entries[token] = (monotonic() + self.ttl, token_expiry(token), actor)
+    self._subjects.setdefault(actor.slug, set()).add(token)
+
+    while len(self._entries) > self.max_size:
+      self._discard(next(iter(self._entries)))
+
+  def invalidate(self, subject: str):
+    """Forgets every cached token of the subject"""
+    for token in self._subjects.pop(subject, set()):
+      self._entries.pop(token, None)
+
+  def clear(self):
+    self._entries.clear()
+    self._subjects.clear()
+
+  def _discard(self, token: str):
+    entry = self._entries.pop(token, None)
+    if entry:
+      slug = entry[-1].slug
+      tokens = self._subjects.get(slug)
+      if tokens:
+        tokens.discard(token)
+        if not tokens:
+          del self._subjects[slug]
+
+actor_cache = ActorCache()
@@ -2,12 +2,12 @@ from os import environ
 from types import ModuleType
 from typing import Any, Dict
 from uuid import uuid4
-from json import dumps, loads
+from asyncio import FIRST_COMPLETED, Queue, Semaphore, gather, create_task, wait
 from datetime import datetime
 
 from sanic import Sanic, response
 from sanic.request import Request
-from sanic.exceptions import Unauthorized
+from sanic.exceptions import Unauthorized, NotFound, InvalidUsage
 from sanic.log import logger
 
 from jinja2 import FileSystemLoader
@@ -21,9 +21,20 @@ from pymongo import MongoClient
 from elasticsearch_async import AsyncElasticsearch
 
 from config import Config, Development, Production
+from encoding import dumps, loads
+from backlog import BacklogWriter
+from actors import actor_cache
+from authz import permission_matrix
+from passwords import password_hasher
+from counters import bump
+from urls import url_chain
+from channels import Connection, LocalBroker, MongoBroker, MessageWriter
+from search import INDEXED_MEMBERS, ElasticsearchBackend, LocalBackend, CachedSearch
+from files import DOWNLOAD_PREFIX, UPLOAD_PREFIX, file_etag, parse_range, download_url, multipart_boundary, disposition_filename, MultipartReader
 
 import models
-from features import Aspect
+from features import Aspect, messages_page
+from pages import page_size
 
 from yrest.auth import AuthToken
 from yrest.utils import Ok, ErrorMessage
@@ -41,8 +52,20 @@ class Server(MongoServer, OpenApi):
   def __init__(self, root_model: models.Tree, models: ModuleType, **kwargs: Dict[str, Any]):
     super().__init__(root_model, models, **kwargs)
 
+    self.add_route(self.download, f"{DOWNLOAD_PREFIX}/<filename:path>", ["GET"])
+    self.add_route(self.upload, f"{UPLOAD_PREFIX}/<path:path>", ["POST"], stream = True)
+
     self.register_listener(self._set_es, 'before_server_start')
     self.register_listener(self._close_es, 'before_server_stop')
+    self.register_listener(self._ensure_indexes, 'before_server_start')
+    self.register_listener(self._configure_actors, 'before_server_start')
+    self.register_listener(self._start_backlog, 'before_server_start')
+    self.register_listener(self._stop_backlog, 'before_server_stop')
+    self.register_listener(self._start_broker, 'before_server_start')
+    self.register_listener(self._stop_broker, 'before_server_stop')
+    self.register_listener(self._start_search, 'before_server_start')
+    self.register_listener(self._stop_search, 'before_server_stop')
+    self.register_listener(self._close_passwords, 'after_server_stop')
 
   async def _set_es(self, app, loop):
     app._es = AsyncElasticsearch(hosts = app.config.get("ES_SERVERS", ["localhost"]))
@@ -50,6 +73,236 @@ class Server(MongoServer, OpenApi):
   async def _close_es(self, app, loop):
     app._es.transport.close()
 
+  async def _start_search(self, app, loop):
+    if app.config.get("SEARCH_BACKEND", "elasticsearch") == "local":
+      app._search = LocalBackend.from_config(app._table, app.config)
+    else:
+      app._search = ElasticsearchBackend(app._es, app.config.get("SEARCH_ES_INDEX", "gd.gd,gd.fs.files"))
+    if app.config.get("SEARCH_CACHE_SIZE"):
+      app._search = CachedSearch.from_config(app._search, app.config)
+    await app._search.start()
+
+  async def _stop_search(self, app, loop):
+    await app._search.close()
+
+  async def _ensure_indexes(self, app, loop):
+    await app._table.create_index([("type", 1), ("ancestor_urls", 1), ("date", -1)])
+    await app._table.database["fs.files"].create_index([("metadata.ancestor_urls", 1), ("uploadDate", -1)])
+    await app._table.create_index([("grants.scope", 1), ("grants.role", 1)])
+    await app._table.create_index("grants.role")
+
+    backlog = app._table.database[app.config.get("BACKLOG_COLLECTION", "backlog")]
+    await backlog.create_index([("ancestor_urls", 1), ("date", -1)])
+    await backlog.create_index([("user", 1), ("aspect", 1), ("date", -1)])
+    await app._table.database[app.config.get("ACTIVITY_COLLECTION", "activity")].create_index([("node", 1), ("granularity", 1), ("bucket", 1)])
+    if app.config.get("BACKLOG_RETENTION_DAYS"):
+      await backlog.create_index("date", expireAfterSeconds = app.config["BACKLOG_RETENTION_DAYS"] * 86400)
+
+  async def _configure_actors(self, app, loop):
+    actor_cache.configure(app.config)
+    permission_matrix.configure(app.config)
+    password_hasher.configure(app.config)
+
+  async def _close_passwords(self, app, loop):
+    password_hasher.close()
+
+  async def _get_actor(self, request: Request):
+    """Resolves the request's actor once and caches it by its token"""
+    if not hasattr(request.ctx, "actor"):
+      raw = request.headers.get("Authorization")
+      actor = actor_cache.get(raw) if raw else None
+      if actor is None:
+        token = AuthToken.get(request.headers)
+        actor = await token.get_actor(self._table, self.config["JWT_SECRET"], self._models.User)
+        if raw and actor:
+          actor_cache.set(raw, actor)
+      request.ctx.actor = actor
+
+    return request.ctx.actor
+
+  async def _start_backlog(self, app, loop):
+    app._backlog_table = app._table.database[app.config.get("BACKLOG_COLLECTION", "backlog")]
+    app._activity_table = app._table.database[app.config.get("ACTIVITY_COLLECTION", "activity")]
+    app._backlog = BacklogWriter.from_config(app._backlog_table, app._table, app._activity_table, app.config)
+    app._backlog.start(loop)
+
+  async def _stop_backlog(self, app, loop):
+    await app._backlog.stop()
+
+  async def _start_broker(self, app, loop):
+    if app.config.get("WS_BROKER", "local") == "mongo":
+      app._broker = MongoBroker.from_config(app._table, self._message_frame, app.config)
+    else:
+      app._broker = LocalBroker()
+    await app._broker.start(self._deliver)
+
+    app._messages = MessageWriter.from_config(app._table, app.config) if app.config.get("WS_PERSISTENCE", "sync") == "buffered" else None
+    if app._messages:
+      app._messages.start()
+
+  async def _stop_broker(self, app, loop):
+    if app._messages:
+      await app._messages.stop()
+    await app._broker.stop()
+
+  def _deliver(self, room: str, frame):
+    """Fans the frame out to this worker's sockets in the room"""
+    for user, conn in self.connections.get(room, {}).items():
+      conn.send(frame)
+
+  @staticmethod
+  def _message_frame(doc: Dict[str, Any]) -> str:
+    return dumps({"message": doc["message"], "user": doc["user"], "date": doc["date"]})
+
+  async def _log(self, request: Request, email: str, runned_path: str, aspect: Aspect):
+    backlog = request.app._models.Backlog(date = datetime.utcnow(), user = email, runned_path = runned_path, aspect = aspect, ancestor_urls = url_chain(runned_path))
+    await request.app._backlog.put(backlog)
+
+  async def _allowed_node(self, request: Request, url: str, member: str):
+    """Returns the node at url if the request's actor is allowed to run its member"""
+    doc = await self._table.find_one(self._models.Group._decompose_url(url))
+    if not doc:
+      raise NotFound(f"{url} can't be found")
+
+    node = getattr(self._models, doc["type"])(**doc)
+    node._table = self._table
+    mask = await permission_matrix.get(self._table, doc["type"], member)
+    if mask is None or not permission_matrix.allowed(await self._get_actor(request), node, mask):
+      raise Unauthorized(f"You can't {member} at {url}")
+
+    return node
+
+  async def download(self, request: Request, filename: str):
+    """Streams a file from GridFS honoring Range and If-None-Match"""
+    files = await self._gridfs.find({"filename": f"/{filename}"}).sort("uploadDate", -1).limit(1).to_list(1)
+    if not files:
+      raise NotFound("The file can't be found")
+    file = files[0]
+
+    await self._allowed_node(request, file.metadata["parent"], "get_files")
+
+    etag = file_etag(file)
+    headers = {"ETag": etag, "Accept-Ranges": "bytes", "Cache-Control": "private"}
+    if etag in request.headers.get("If-None-Match", ""):
+      return response.HTTPResponse(status = 304, headers = headers)
+
+    try:
+      byte_range = parse_range(request.headers.get("Range"), file.length)
+    except ValueError:
+      headers["Content-Range"] = f"bytes */{file.length}"
+      return response.HTTPResponse(status = 416, headers = headers)
+
+    status = 200
+    start, end = 0, file.length - 1
+    if byte_range and request.headers.get("If-Range", etag) == etag:
+      status = 206
+      start, end = byte_range
+      headers["Content-Range"] = f"bytes {start}-{end}/{file.length}"
+    headers["Content-Length"] = str(end - start + 1)
+
+    async def stream(res):
+      grid_out = await self._gridfs.open_download_stream(file._id)
+      grid_out.seek(start)
+      remaining = end - start + 1
+      while remaining > 0:
+        chunk = await grid_out.read(min(file.chunk_size, remaining))
+        if not chunk:
+          break
+        remaining -= len(chunk)
+        await res.write(chunk)
+
+    return response.stream(stream, status = status, headers = headers, content_type = file.metadata["contentType"])
+
+  async def upload(self, request: Request, path: str):
+    """Streams the files of a multipart body into GridFS"""
+    url = f"/{path}"
+    await self._allowed_node(request, url, "upload_files")
+
+    boundary = multipart_boundary(request.headers.get("Content-Type", ""))
+    if not boundary:
+      raise InvalidUsage("A multipart/form-data body is expected")
+
+    reader = MultipartReader(boundary)
+    limit = Semaphore(self.config.get("UPLOAD_CONCURRENCY", 4))
+    uploads = []
+    chunks = None
+    try:
+      while not reader.done:
+        body = await request.stream.read()
+        if body is None:
+          raise InvalidUsage("The multipart body is incomplete")
+        for event, value in reader.feed(body):
+          if event == "headers":
+            filename = disposition_filename(value.get("content-disposition", ""))
+            chunks = Queue(self.config.get("UPLOAD_QUEUE_CHUNKS", 4)) if filename else None
+            if chunks:
+              uploads.append(create_task(self._store_file(url, filename, value.get("content-type", "application/octet-stream"), chunks, limit)))
+          elif chunks and event == "data":
+            await self._feed(uploads[-1], chunks, value)
+          elif chunks and event == "end":
+            await self._feed(uploads[-1], chunks, None)
+            chunks = None
+    except BaseException as e:
+      for upload in uploads:
+        upload.cancel()
+      await self._stored(url, uploads)
+      raise InvalidUsage(str(e)) if isinstance(e, ValueError) else e
+
+    stored = await self._stored(url, uploads)
+    failed = next((upload.exception() for upload in uploads if not upload.cancelled() and upload.exception()), None)
+    if failed:
+      raise failed
+
+    return response.json({file["filename"]: file for file in stored})
+
+  @staticmethod
+  async def _feed(upload, chunks: Queue, value):
+    """Queues the chunk for its upload, failing when the upload has failed instead of waiting for it forever"""
+    if upload.done():
+      upload.result()
+      raise InvalidUsage("The upload ended before its file")
+    if not chunks.full():
+      chunks.put_nowait(value)
+      return
+
+    put = create_task(chunks.put(value))
+    try:
+      await wait({put, upload}, return_when = FIRST_COMPLETED)
+    finally:
+      if not put.done():
+        put.cancel()
+    if not put.done() or put.cancelled():
+      upload.result()
+      raise InvalidUsage("The upload ended before its file")
+
+  async def _stored(self, url: str, uploads):
+    """Waits for the uploads and counts the files that were stored"""
+    stored = [file for file in await gather(*uploads, return_exceptions = True) if isinstance(file, dict)]
+    if stored:
+      await bump(self._table, url, files = len(stored), bytes = sum(file["length"] for file in stored))
+      self._search.touched(url)
+    return stored
+
+  async def _store_file(self, url: str, name: str, content_type: str, chunks: Queue, limit: Semaphore):
+    filename = f"{url}/{name}"
+    metadata = {"contentType": content_type, "parent": url, "ancestor_urls": url_chain(url)}
+    async with limit:
+      grid_in = self._gridfs.open_upload_stream(filename, metadata = metadata)
+      length = 0
+      try:
+        while True:
+          chunk = await chunks.get()
+          if chunk is None:
+            break
+          await grid_in.write(chunk)
+          length += len(chunk)
+        await grid_in.close()
+      except BaseException:
+        await grid_in.abort()
+        raise
+
+    return {"filename": filename, "content_type": content_type, "length": length, "url": download_url(filename)}
+
   async def ws_endpoint(self, request, ws):
     from websockets.exceptions import ConnectionClosed
     """Websocket channel"""
@@ -58,103 +311,124 @@ class Server(MongoServer, OpenApi):
     actor = None
     messageClass = self._models.Message
     project = None
+    connection = None
+    broker = self._broker
     while True:
       try:
         data = await ws.recv()
-        print(f"Received: {data}")
-        if isinstance(data, str):
-          data_obj = loads(data)
+        data_obj = loads(data)
         if "connected" in data_obj.keys():
           actor = data_obj["connected"]
           room = data_obj["room"]
           if room not in self.connections.keys():
             self.connections[room] = {}
-          messages = await messageClass.gets(self._table, path = room)
-          await ws.send(dumps({"users": list(self.connections[room].keys()), "messages": [message.to_plain_dict() for message in messages]}))
-          self.connections[room][actor] = ws
+          messages, before = await messages_page(self, room, None, self.config.get("WS_HISTORY_SIZE", 50))
+          await ws.send(dumps({"users": await broker.users(room), "messages": [message.to_plain_dict() for message in messages], "before": before}))
+          connection = Connection.from_config(ws, self.config)
+          self.connections[room][actor] = connection
+          await broker.join(room, actor)
           project = await self._models.Project.get(self._table, url = room)
           actor = await self._models.User.get(self._table, slug = actor)
+        elif "history_before" in data_obj.keys():
+          if connection is None:
+            await ws.send(dumps({"error": "Join a room before asking for its history"}))
+            continue
+          limit = page_size(data_obj.get("limit"), self.config)
+          try:
+            messages, before = await messages_page(self, room, data_obj["history_before"], limit)
+            connection.send(dumps({"history": [message.to_plain_dict() for message in messages], "before": before}))
+          except InvalidUsage as e:
+            connection.send(dumps({"error": str(e)}))
+          continue
         elif "disconnected" in data_obj.keys():
           raise CloseConnection
       except (ConnectionClosed, CloseConnection):
-        print(f"{actor.name} died")
-        del self.connections[room][actor.slug]
-        for user, conn in self.connections[room].items():
-          await conn.send({"disconnected": actor.slug})
+        if actor:
+          logger.info(f"{actor.name} left {room}")
+          self.connections[room].pop(actor.slug, None)
+          connection.close()
+          await broker.leave(room, actor.slug)
+          await broker.publish(room, dumps({"disconnected": actor.slug}))
         break
 
       if data:
-        dataObj = loads(data)
-        if "message" in dataObj:
-          message = messageClass(user = actor.email, date = datetime.utcnow(), message = dataObj["message"])
+        if "message" in data_obj:
+          message = messageClass(user = actor.email, date = datetime.utcnow(), message = data_obj["message"])
           message._table = self._table
-          await project.create_child(message, self._models)
-
-        for user, conn in self.connections[room].items():
-          print(f"Sending: {data} to: {user}")
-          await conn.send(data)
+          frame = self._message_frame({"message": message.message, "user": message.user, "date": message.date})
+          if self._messages:
+            await broker.publish_message(room, frame)
+            slug = message.date.isoformat()
+            await self._messages.put(room, message, lambda durable, slug = slug, conn = connection: conn.send(dumps({"ack" if durable else "nack": slug})))
+          else:
+            await project.create_child(message, self._models)
+            await bump(self._table, room, message.date, messages = 1)
+            await broker.publish_message(room, frame)
+        else:
+          await broker.publish(room, data)
 
   async def auth(self, request: Request):
-    result = await super().auth(request)
-    backlog = request.app._models.Backlog(date = datetime.utcnow(), user = request.json["email"], runned_path = f"/auth", aspect = Aspect.AUTH)
-    backlog._table = self._table
-    await backlog.create()
+    """Checks the credentials in the password pool and issues the token here, yrest's auth would check them again on the loop"""
+    credentials = request.json or {}
+    await self._log(request, credentials.get("email", "anonymous"), f"/auth", Aspect.AUTH)
 
-    return result
+    user = await self._table.find_one({"type": "User", "email": credentials.get("email")}, projection = {"slug": 1, "password": 1})
+    if not user or not await password_hasher.check(user.get("password"), credentials.get("password")):
+      return response.json(ErrorMessage(message = "Authentication has failed", code = 401), 401)
+
+    token = AuthToken()
+    token.generate({"user_id": str(user["_id"])}, self.config["JWT_SECRET"])
+
+    await self._table.update_one({"_id": user["_id"]}, {"$set": {"last_login": datetime.utcnow()}})
+    actor_cache.invalidate(user["slug"])
+
+    return response.json(token.to_plain_dict())
 
   async def updater(self, request: Request, path: str = None):
     result = await super().updater(request, path)
+    self._search.touched(f"/{path}")
 
-    token = AuthToken.get(request.headers)
-    actor = await token.get_actor(self._table, self.config["JWT_SECRET"], self._models.User)
+    actor = await self._get_actor(request)
     email = actor.email if actor else "anonymous"
-    # actor = await self._models.User.get(self._table, slug = "garito")
 
-    backlog = request.app._models.Backlog(date = datetime.utcnow(), user = email, runned_path = f"/{path}", aspect = Aspect.UPDATER)
-    backlog._table = self._table
-    await backlog.create()
+    await self._log(request, email, f"/{path}", Aspect.UPDATER)
 
     return result
 
   async def dispatcher(self, request: Request, path: str = None):
     result = await super().dispatcher(request, path)
+    if path and path.rsplit("/", 1)[-1] in INDEXED_MEMBERS and getattr(result, "status", 200) < 400:
+      self._search.touched(f"/{path}")
 
-    token = AuthToken.get(request.headers)
-    actor = await token.get_actor(self._table, self.config["JWT_SECRET"], self._models.User)
+    actor = await self._get_actor(request)
     email = actor.email if actor else "anonymous"
-    # actor = await self._models.User.get(self._table, slug = "garito")
 
-    backlog = request.app._models.Backlog(date = datetime.utcnow(), user = email, runned_path = f"/{path}" if path else "/", aspect = Aspect.DISPATCHER)
-    backlog._table = self._table
-    await backlog.create()
+    await self._log(request, email, f"/{path}" if path else "/", Aspect.DISPATCHER)
 
     return result
 
   async def factory(self, request: Request, model, path: str = None):
     result = await super().factory(request, model, path)
+    self._search.touched(f"/{path}")
+    counter = {"phase": "phases", "message": "messages"}.get(str(model).lower())
+    if counter and getattr(result, "status", 200) < 400:
+      await bump(self._table, f"/{path}", **{counter: 1})
 
-    token = AuthToken.get(request.headers)
-    actor = await token.get_actor(self._table, self.config["JWT_SECRET"], self._models.User)
+    actor = await self._get_actor(request)
     email = actor.email if actor else "anonymous"
-    # actor = await self._models.User.get(self._table, slug = "garito")
 
-    backlog = request.app._models.Backlog(date = datetime.utcnow(), user = email, runned_path = f"/{path}", aspect = Aspect.FACTORY)
-    backlog._table = self._table
-    await backlog.create()
+    await self._log(request, email, f"/{path}", Aspect.FACTORY)
 
     return result
 
   async def remover(self, request: Request, path: str = None):
     result = await super().remover(request, path)
+    self._search.touched(f"/{path}")
 
-    token = AuthToken.get(request.headers)
-    actor = await token.get_actor(self._table, self.config["JWT_SECRET"], self._models.User)
+    actor = await self._get_actor(request)
     email = actor.email if actor else "anonymous"
-    # actor = await self._models.User.get(self._table, slug = "garito")
 
-    backlog = request.app._models.Backlog(date = datetime.utcnow(), user = email, runned_path = f"/{path}", aspect = Aspect.REMOVER)
-    backlog._table = self._table
-    await backlog.create()
+    await self._log(request, email, f"/{path}", Aspect.REMOVER)
 
     return result
 
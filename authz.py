@@ -0,0 +1,110 @@
+from time import monotonic
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+def grant(role: str, scope: str) -> Dict[str, str]:
+  """Returns the grant of role at the scope url"""
+  return {"role": role, "scope": scope}
+
+def segments(url: str) -> List[str]:
+  return [segment for segment in url.split("/") if segment]
+
+class RoleIndex:
+  """The actor's roles as bitmasks, global ones and a trie of the granted ones by url segments"""
+  def __init__(self, key: Tuple, matrix: "PermissionMatrix"):
+    self.key = key
+    self.mask = 0
+    self.trie = {}
+
+    roles, grants = key
+    for role in roles:
+      self.mask |= matrix.bit(role)
+
+    for role, scope in grants:
+      node = self.trie
+      for segment in segments(scope):
+        node = node.setdefault("children", {}).setdefault(segment, {})
+      node["mask"] = node.get("mask", 0) | matrix.bit(role)
+
+  def scoped(self, url: str) -> int:
+    """Returns the mask of the roles held at url or any of its ancestors"""
+    mask = self.mask | self.trie.get("mask", 0)
+    node = self.trie
+    for segment in segments(url):
+      node = node.get("children", {}).get(segment)
+      if node is None:
+        break
+      mask |= node.get("mask", 0)
+    return mask
+
+class PermissionMatrix:
+  """Process wide map of context/name to the bitmask of the roles allowed to run it"""
+  def __init__(self, ttl: float = 60.0):
+    self.ttl = ttl
+
+    self._bits = {}
+    self._masks = None
+    self._docs = {}
+    self._expires = 0.0
+
+  def configure(self, config):
+    self.ttl = config.get("PERMISSION_MATRIX_TTL", self.ttl)
+
+  def bit(self, role: str) -> int:
+    if role not in self._bits:
+      self._bits[role] = 1 << len(self._bits)
+    return self._bits[role]
+
+  def mask(self, roles: Iterable[str]) -> int:
+    """Returns the mask of roles, 0 when everybody is allowed"""
+    mask = 0
+    for role in roles:
+      mask |= self.bit(role)
+    return mask
+
+  async def _load(self, table):
+    if self._masks is None or self._expires < monotonic():
+      masks = {}
+      docs = {}
+      async for doc in table.find({"type": "Permission"}):
+        key = f"{doc['context']}/{doc['name']}"
+        masks[key] = self.mask(doc.get("roles") or [])
+        docs[key] = doc
+      self._masks = masks
+      self._docs = docs
+      self._expires = monotonic() + self.ttl
+
+  async def get(self, table, context: str, name: str) -> Optional[int]:
+    """Returns the mask of the permission, None when it doesn't exist"""
+    await self._load(table)
+    return self._masks.get(f"{context}/{name}")
+
+  async def document(self, table, context: str, name: str) -> Optional[Dict[str, Any]]:
+    """Returns the permission's document as it was loaded, None when it doesn't exist"""
+    await self._load(table)
+    doc = self._docs.get(f"{context}/{name}")
+    return dict(doc) if doc else None
+
+  def invalidate(self):
+    self._masks = None
+
+  def index(self, actor) -> RoleIndex:
+    """Returns the actor's role index, rebuilt when its roles have changed"""
+    key = (tuple(actor.roles), tuple((user_grant["role"], user_grant["scope"]) for user_grant in getattr(actor, "grants", [])))
+    index = getattr(actor, "_role_index", None)
+    if index is None or index.key != key:
+      index = RoleIndex(key, self)
+      actor._role_index = index
+    return index
+
+  def allowed(self, actor, context: Any, mask: int) -> bool:
+    if not mask:
+      return True
+    if not actor:
+      return False
+
+    actor_mask = self.index(actor).scoped(context.get_url())
+    if actor == context:
+      actor_mask |= self.bit("owner")
+    return bool(actor_mask & mask)
+
+permission_matrix = PermissionMatrix()
@@ -0,0 +1,123 @@
+from asyncio import Queue, QueueFull, gather, wait_for, get_event_loop, TimeoutError, CancelledError
+from json import dumps
+from typing import Any, Dict, List
+
+from sanic.log import logger
+
+from counters import activity_updates
+from documents import to_document
+from rollups import rollup_updates
+
+class BacklogWriter:
+  """Write-behind queue that persists backlog entries in batches"""
+  OVERFLOW_POLICIES = ("block", "drop", "spill")
+
+  def __init__(self, table, nodes, rollups, batch_size: int = 500, flush_interval: float = 1.0, max_size: int = 10000, overflow: str = "block", spill_path: str = "backlog.spill.jsonl"):
+    if overflow not in self.OVERFLOW_POLICIES:
+      raise ValueError(f"Unknown backlog overflow policy: {overflow}")
+
+    self._table = table
+    self._nodes = nodes
+    self._rollups = rollups
+    self.batch_size = batch_size
+    self.flush_interval = flush_interval
+    self.overflow = overflow
+    self.spill_path = spill_path
+    self.dropped = 0
+
+    self._queue = Queue(maxsize = max_size)
+    self._pending = []
+    self._task = None
+
+  @classmethod
+  def from_config(cls, table, nodes, rollups, config):
+    return cls(table, nodes, rollups, batch_size = config.get("BACKLOG_BATCH_SIZE", 500), flush_interval = config.get("BACKLOG_FLUSH_INTERVAL", 1.0),
+      max_size = config.get("BACKLOG_QUEUE_SIZE", 10000), overflow = config.get("BACKLOG_OVERFLOW", "block"),
+      spill_path = config.get("BACKLOG_SPILL_PATH", "backlog.spill.jsonl"))
+
+  def start(self, loop):
+    self._task = loop.create_task(self._run())
+
+  async def stop(self):
+    """Stops the flushing task and persists what is still queued"""
+    if self._task:
+      self._task.cancel()
+      try:
+        await self._task
+      except CancelledError:
+        pass
+      self._task = None
+
+    pending, self._pending = self._pending, []
+    await self._flush(pending)
+    while not self._queue.empty():
+      await self._flush(self._take(self.batch_size))
+
+  async def put(self, entry):
+    """Enqueues the entry applying the overflow policy when the queue is full"""
+    doc = to_document(entry)
+    if self.overflow == "block":
+      await self._queue.put(doc)
+      return
+
+    try:
+      self._queue.put_nowait(doc)
+    except QueueFull:
+      if self.overflow == "spill":
+        await self._spill([doc])
+      else:
+        self.dropped += 1
+        logger.warning(f"Backlog queue is full, {self.dropped} entries dropped")
+
+  def _take(self, amount: int) -> List[Dict[str, Any]]:
+    batch = []
+    while len(batch) < amount and not self._queue.empty():
+      batch.append(self._queue.get_nowait())
+    return batch
+
+  async def _run(self):
+    while True:
+      try:
+        first = await wait_for(self._queue.get(), self.flush_interval)
+      except TimeoutError:
+        continue
+
+      loop = get_event_loop()
+      deadline = loop.time() + self.flush_interval
+      self._pending = [first] + self._take(self.batch_size - 1)
+      while len(self._pending) < self.batch_size and loop.time() < deadline:
+        try:
+          self._pending.append(await wait_for(self._queue.get(), deadline - loop.time()))
+        except TimeoutError:
+          break
+
+      batch, self._pending = self._pending, []
+      await self._flush(batch)
+
+  async def _flush(self, batch: List[Dict[str, Any]]):
+    if not batch:
+      return
+
+    try:
+      await self._table.insert_many(batch, ordered = False)
+    except CancelledError:
+      await self._spill(batch)
+      raise
+    except Exception as e:
+      logger.error(f"Can't persist {len(batch)} backlog entries: {e}")
+      await self._spill(batch)
+      return
+
+    try:
+      await gather(self._nodes.bulk_write(activity_updates(batch), ordered = False), self._rollups.bulk_write(rollup_updates(batch), ordered = False))
+    except Exception as e:
+      logger.error(f"Can't update the activity counters and rollups: {e}")
+
+  async def _spill(self, docs: List[Dict[str, Any]]):
+    """Appends the docs to the spill file, without the _id insert_many may have set"""
+    lines = "".join(dumps({key: value for key, value in doc.items() if key != "_id"}, default = str) + "\n" for doc in docs)
+    await get_event_loop().run_in_executor(None, self._append, lines)
+
+  def _append(self, lines: str):
+    with open(self.spill_path, "a") as f:
+      f.write(lines)
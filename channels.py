@@ -0,0 +1,284 @@
+from asyncio import Event, Queue, CancelledError, create_task, gather, shield, sleep, wait_for
+from collections import deque
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Tuple, Union
+from uuid import uuid4
+
+from pymongo import UpdateOne
+
+from sanic.log import logger
+
+from documents import to_document
+from counters import node_filter, updates
+from urls import url_chain
+
+Frame = Union[str, bytes]
+
+class Connection:
+  """Websocket with a bounded outbound queue drained by its own writer task"""
+  SLOW_CONSUMER_POLICIES = ("drop_oldest", "coalesce", "disconnect")
+
+  def __init__(self, ws, max_size: int = 100, policy: str = "drop_oldest", timeout: float = 10.0):
+    if policy not in self.SLOW_CONSUMER_POLICIES:
+      raise ValueError(f"Unknown slow consumer policy: {policy}")
+
+    self.ws = ws
+    self.max_size = max_size
+    self.policy = policy
+    self.timeout = timeout
+    self.closed = False
+
+    self._frames = deque()
+    self._ready = Event()
+    self._task = create_task(self._write())
+
+  @classmethod
+  def from_config(cls, ws, config):
+    return cls(ws, max_size = config.get("WS_QUEUE_SIZE", 100), policy = config.get("WS_SLOW_CONSUMER", "drop_oldest"), timeout = config.get("WS_SEND_TIMEOUT", 10.0))
+
+  def send(self, frame: Frame):
+    """Enqueues the frame without waiting for the client"""
+    if self.closed:
+      return
+
+    if len(self._frames) >= self.max_size:
+      if self.policy == "disconnect":
+        logger.warning("Disconnecting a slow websocket consumer")
+        self.close()
+        return
+      elif self.policy == "coalesce":
+        self._frames = deque([self._merge(self._frames)])
+      else:
+        self._frames.popleft()
+
+    self._frames.append(frame)
+    self._ready.set()
+
+  def close(self):
+    if not self.closed:
+      self.closed = True
+      self._frames.clear()
+      self._ready.set()
+      create_task(self.ws.close())
+
+  @staticmethod
+  def _merge(frames) -> List[Frame]:
+    """Returns the frames as one pending batch, flattening the batches already merged"""
+    merged = []
+    for frame in frames:
+      merged.extend(frame if isinstance(frame, list) else [frame])
+    return merged
+
+  def _next_frame(self) -> Frame:
+    if self.policy != "coalesce":
+      return self._frames.popleft()
+
+    frames = self._merge(self._frames)
+    self._frames.clear()
+    if len(frames) == 1:
+      return frames[0]
+    if isinstance(frames[0], bytes):
+      return b'{"batch": [' + b",".join(frames) + b"]}"
+    return '{"batch": [' + ",".join(frames) + "]}"
+
+  async def _write(self):
+    while not self.closed:
+      await self._ready.wait()
+      self._ready.clear()
+      while self._frames and not self.closed:
+        try:
+          await wait_for(self.ws.send(self._next_frame()), self.timeout)
+        except Exception:
+          self.close()
+
+class LocalBroker:
+  """Room pub/sub that only reaches the sockets of this process"""
+  def __init__(self):
+    self._deliver = None
+    self._presence = {}
+
+  async def start(self, deliver: Callable[[str, Frame], None]):
+    self._deliver = deliver
+
+  async def stop(self):
+    self._presence.clear()
+
+  async def publish(self, room: str, frame: Frame):
+    self._deliver(room, frame)
+
+  async def publish_message(self, room: str, frame: Frame):
+    """Publishes the frame of a chat message that is being persisted"""
+    self._deliver(room, frame)
+
+  async def join(self, room: str, user: str):
+    self._presence.setdefault(room, set()).add(user)
+
+  async def leave(self, room: str, user: str):
+    self._presence.get(room, set()).discard(user)
+
+  async def users(self, room: str) -> List[str]:
+    return sorted(self._presence.get(room, set()))
+
+class MongoBroker(LocalBroker):
+  """Room pub/sub across workers and nodes through Mongo change streams
+
+  Chat messages are delivered from the Message inserts (or as events when their persistence is buffered), the rest of the frames travel through a TTL'd events collection and the presence is kept per worker with heartbeats"""
+  def __init__(self, table, message_frame: Callable[[Dict[str, Any]], Frame], heartbeat: float = 10.0, watch_messages: bool = True):
+    super().__init__()
+    self.worker = uuid4().hex
+    self.heartbeat = heartbeat
+    self.watch_messages = watch_messages
+
+    self._table = table
+    self._events = table.database[f"{table.name}.ws_events"]
+    self._presence_table = table.database[f"{table.name}.ws_presence"]
+    self._message_frame = message_frame
+    self._tasks = []
+
+  @classmethod
+  def from_config(cls, table, message_frame, config):
+    return cls(table, message_frame, heartbeat = config.get("WS_PRESENCE_HEARTBEAT", 10.0), watch_messages = config.get("WS_PERSISTENCE", "sync") != "buffered")
+
+  async def start(self, deliver: Callable[[str, Frame], None]):
+    await super().start(deliver)
+    await self._events.create_index("date", expireAfterSeconds = 60)
+    await self._presence_table.create_index("date", expireAfterSeconds = int(self.heartbeat * 3))
+    await self._presence_table.create_index([("room", 1), ("user", 1)])
+
+    messages = [{"$match": {"operationType": "insert", "fullDocument.type": "Message"}}]
+    events = [{"$match": {"operationType": "insert", "fullDocument.worker": {"$ne": self.worker}}}]
+    self._tasks = [
+      create_task(self._watch(self._events, events, lambda doc: (doc["room"], doc["frame"]))),
+      create_task(self._beat())
+    ]
+    if self.watch_messages:
+      self._tasks.append(create_task(self._watch(self._table, messages, lambda doc: (doc["path"], self._message_frame(doc)))))
+
+  async def stop(self):
+    for task in self._tasks:
+      task.cancel()
+    await gather(*self._tasks, return_exceptions = True)
+    self._tasks = []
+    await self._presence_table.delete_many({"worker": self.worker})
+    await super().stop()
+
+  async def publish(self, room: str, frame: Frame):
+    self._deliver(room, frame)
+    await self._events.insert_one({"room": room, "frame": frame, "worker": self.worker, "date": datetime.utcnow()})
+
+  async def publish_message(self, room: str, frame: Frame):
+    """Unless the messages are persisted after the broadcast, their inserts deliver them to every worker"""
+    if not self.watch_messages:
+      await self.publish(room, frame)
+
+  async def join(self, room: str, user: str):
+    await super().join(room, user)
+    await self._presence_table.update_one({"_id": f"{self.worker}|{room}|{user}"}, {"$set": {"room": room, "user": user, "worker": self.worker, "date": datetime.utcnow()}}, upsert = True)
+
+  async def leave(self, room: str, user: str):
+    await super().leave(room, user)
+    await self._presence_table.delete_one({"_id": f"{self.worker}|{room}|{user}"})
+
+  async def users(self, room: str) -> List[str]:
+    return sorted(await self._presence_table.distinct("user", {"room": room}))
+
+  async def _watch(self, collection, pipeline, route):
+    while True:
+      try:
+        async with collection.watch(pipeline) as stream:
+          async for change in stream:
+            self._deliver(*route(change["fullDocument"]))
+      except CancelledError:
+        raise
+      except Exception as e:
+        logger.error(f"Room change stream on {collection.name} failed: {e}")
+        await sleep(1)
+
+  async def _beat(self):
+    while True:
+      await sleep(self.heartbeat)
+      try:
+        await self._presence_table.update_many({"worker": self.worker}, {"$set": {"date": datetime.utcnow()}})
+      except Exception as e:
+        logger.error(f"Can't refresh the websocket presence: {e}")
+
+class MessageWriter:
+  """Persists the chat messages in per room bulk inserts after they have been broadcasted"""
+  def __init__(self, table, batch_size: int = 200, flush_interval: float = 0.2, max_size: int = 10000):
+    self._table = table
+    self.batch_size = batch_size
+    self.flush_interval = flush_interval
+
+    self._queue = Queue(maxsize = max_size)
+    self._pending = []
+    self._task = None
+    self._flushing = None
+
+  @classmethod
+  def from_config(cls, table, config):
+    return cls(table, batch_size = config.get("WS_PERSISTENCE_BATCH_SIZE", 200), flush_interval = config.get("WS_PERSISTENCE_INTERVAL", 0.2),
+      max_size = config.get("WS_PERSISTENCE_QUEUE_SIZE", 10000))
+
+  def start(self):
+    self._task = create_task(self._run())
+
+  async def stop(self):
+    """Stops the flushing task, lets the in-flight flush finish and persists what is still queued"""
+    if self._task:
+      self._task.cancel()
+      await gather(self._task, return_exceptions = True)
+      self._task = None
+    if self._flushing:
+      await gather(self._flushing, return_exceptions = True)
+      self._flushing = None
+
+    pending, self._pending = self._pending, []
+    while not self._queue.empty():
+      pending.append(self._queue.get_nowait())
+    await self._flush(pending)
+
+  async def put(self, room: str, message, ack: Callable[[bool], None]):
+    """Enqueues the message, ack is called once it is durable"""
+    message.path = room
+    message.ancestor_urls = url_chain(room)
+    await self._queue.put((room, to_document(message), ack))
+
+  async def _run(self):
+    while True:
+      self._pending.append(await self._queue.get())
+      await sleep(self.flush_interval)
+      while len(self._pending) < self.batch_size and not self._queue.empty():
+        self._pending.append(self._queue.get_nowait())
+
+      batch, self._pending = self._pending, []
+      self._flushing = create_task(self._flush(batch))
+      await shield(self._flushing)
+      self._flushing = None
+
+  async def _flush(self, batch: List[Tuple[str, Dict[str, Any], Callable[[bool], None]]]):
+    rooms = {}
+    for room, doc, ack in batch:
+      rooms.setdefault(room, []).append((doc, ack))
+
+    await gather(*[self._flush_room(room, entries) for room, entries in rooms.items()])
+
+  async def _flush_room(self, room: str, entries: List[Tuple[Dict[str, Any], Callable[[bool], None]]]):
+    entries.sort(key = lambda entry: entry[0]["slug"])
+    docs = [doc for doc, _ in entries]
+    try:
+      await self._table.insert_many(docs, ordered = True)
+      durable = True
+    except Exception as e:
+      logger.error(f"Can't persist {len(docs)} messages of {room}: {e}")
+      durable = False
+
+    for _, ack in entries:
+      ack(durable)
+
+    if durable:
+      requests = updates(room, docs[-1]["date"], messages = len(docs))
+      requests.append(UpdateOne(node_filter(room), {"$push": {"messages": {"$each": [doc["slug"] for doc in docs]}}}))
+      try:
+        await self._table.bulk_write(requests, ordered = False)
+      except Exception as e:
+        logger.error(f"Can't update the counters of {room} after {len(docs)} messages: {e}")
@@ -15,6 +15,23 @@ class Config:
   MONGO_GRIDFS = True
 
   ES_SERVERS = ["es1"]
+  SEARCH_BACKEND = "elasticsearch" # elasticsearch or local, the later indexes in process so it needs a single worker
+  SEARCH_ES_INDEX = "gd.gd,gd.fs.files"
+  SEARCH_INDEX_PATH = "search_index"
+  SEARCH_FLUSH_SIZE = 1000
+  SEARCH_MAX_SEGMENTS = 8
+  SEARCH_SIZE = 10
+  SEARCH_CACHE_SIZE = 256 # 0 disables the results' cache
+  SEARCH_CACHE_TTL = 30.0
+
+  BACKLOG_COLLECTION = "backlog"
+  BACKLOG_RETENTION_DAYS = 365
+  ACTIVITY_COLLECTION = "activity"
+  BACKLOG_BATCH_SIZE = 500
+  BACKLOG_FLUSH_INTERVAL = 1.0
+  BACKLOG_QUEUE_SIZE = 10000
+  BACKLOG_OVERFLOW = "block" # block, drop or spill
+  BACKLOG_SPILL_PATH = "backlog.spill.jsonl"
 
   OA_INFO: Dict[str, str] = {
     "title": "Content management",
@@ -39,6 +56,31 @@ class Config:
   else:
     JWT_SECRET = hexlify(urandom(32))
 
+  PAGE_SIZE = 50
+  MAX_PAGE_SIZE = 500
+
+  UPLOAD_CONCURRENCY = 4
+  UPLOAD_QUEUE_CHUNKS = 4
+  FILES_DELETE_BATCH_SIZE = 1000
+  FILES_BACKGROUND_DELETE = 5000 # removes the files of bigger subtrees in the background, 0 always waits
+
+  WS_QUEUE_SIZE = 100
+  WS_SLOW_CONSUMER = "drop_oldest" # drop_oldest, coalesce or disconnect
+  WS_SEND_TIMEOUT = 10.0
+  WS_HISTORY_SIZE = 50
+  WS_BROKER = "local" # local or mongo, the later needs a replica set
+  WS_PRESENCE_HEARTBEAT = 10.0
+  WS_PERSISTENCE = "sync" # sync or buffered, that broadcasts first and acks once persisted
+  WS_PERSISTENCE_BATCH_SIZE = 200
+  WS_PERSISTENCE_INTERVAL = 0.2
+  WS_PERSISTENCE_QUEUE_SIZE = 10000
+
+  ACTOR_CACHE_SIZE = 1024
+  ACTOR_CACHE_TTL = 60.0 # bounds how long other workers' role and grant changes take to apply, expired tokens are never served
+  PASSWORD_WORKERS = 2
+  PASSWORD_QUEUE_SIZE = 64
+  PERMISSION_MATRIX_TTL = 60.0 # bounds how long other workers' permission changes take to apply
+
   SYSTEM_ROLES = {
     "Admin": {"description": "The administrator"},
     # "Invited": {"description": "The non registered user that has asked for an invitation", "system_only": True},
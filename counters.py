@@ -0,0 +1,50 @@
+from collections import defaultdict
+from datetime import datetime
+from typing import Any, Dict, Iterable, List
+
+from pymongo import UpdateOne
+
+from urls import url_chain
+
+COUNTED_TYPES = ["Group", "Project", "Record"]
+COUNTERS = ("files", "bytes", "messages", "phases", "finished", "activity")
+COUNTERS_VERSION = 1
+
+def counted(node) -> bool:
+  """Tells if the node's counters are complete, set by rebuildCounters or since its creation"""
+  return (getattr(node, "counters", None) or {}).get("version") == COUNTERS_VERSION
+
+def new_counters() -> Dict[str, Any]:
+  return dict(dict.fromkeys(COUNTERS, 0), version = COUNTERS_VERSION)
+
+def node_filter(url: str) -> Dict[str, Any]:
+  """Returns the query that matches the counted node at url"""
+  if url == "/":
+    return {"type": {"$in": COUNTED_TYPES}, "path": ""}
+
+  path, slug = url.rsplit("/", 1)
+  return {"type": {"$in": COUNTED_TYPES}, "path": path or "/", "slug": slug}
+
+def updates(url: str, when: datetime = None, **increments: int) -> List[UpdateOne]:
+  """Returns the updates that apply the increments to the node at url and its ancestors"""
+  update = {"$max": {"counters.last_activity": when or datetime.utcnow()}}
+  increments = {f"counters.{name}": amount for name, amount in increments.items() if amount}
+  if increments:
+    update["$inc"] = increments
+
+  return [UpdateOne(node_filter(node), update) for node in url_chain(url)]
+
+async def bump(table, url: str, when: datetime = None, **increments: int):
+  """Increments the counters of the node at url and its ancestors"""
+  await table.bulk_write(updates(url, when, **increments), ordered = False)
+
+def activity_updates(entries: Iterable[Dict[str, Any]]) -> List[UpdateOne]:
+  """Returns the counters' updates of a batch of backlog entries"""
+  amounts = defaultdict(int)
+  last = {}
+  for entry in entries:
+    for node in url_chain(entry["runned_path"]):
+      amounts[node] += 1
+      last[node] = max(last.get(node, entry["date"]), entry["date"])
+
+  return [UpdateOne(node_filter(node), {"$inc": {"counters.activity": amount}, "$max": {"counters.last_activity": last[node]}}) for node, amount in amounts.items()]
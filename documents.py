@@ -0,0 +1,17 @@
+from dataclasses import fields
+from enum import Enum
+from typing import Any, Dict
+
+def to_document(entry) -> Dict[str, Any]:
+  """Returns the mongo document of a model instance"""
+  doc = {}
+  for field in fields(entry):
+    value = getattr(entry, field.name)
+    if field.name.startswith("_") and value is None:
+      continue
+    doc[field.name] = value.value if isinstance(value, Enum) else value
+
+  doc["type"] = entry.__class__.__name__
+  doc["slug"] = entry.__sluger__()
+
+  return doc
@@ -0,0 +1,20 @@
+from json import dumps as json_dumps, loads as json_loads
+from typing import Any
+
+from yrest.ysanic import yJSONEncoder
+
+try:
+  import orjson
+except ImportError:
+  orjson = None
+
+_encoder = yJSONEncoder()
+
+def dumps(obj: Any) -> str:
+  """Serializes obj once with the fastest encoder available, falling back to yJSONEncoder for what it can't handle"""
+  if orjson:
+    return orjson.dumps(obj, default = _encoder.default, option = orjson.OPT_NON_STR_KEYS).decode("UTF-8")
+  return json_dumps(obj, cls = yJSONEncoder)
+
+def loads(data: Any) -> Any:
+  return orjson.loads(data) if orjson else json_loads(data)
@@ -1,10 +1,14 @@
+from asyncio import gather, Semaphore
 from pathlib import PurePath
-from typing import Any, List
+from typing import Any, Dict, List, Optional, Tuple
 from dataclasses import dataclass, field
-from datetime import datetime
+from datetime import datetime, timedelta
 from enum import Enum
+from hashlib import sha1
+from json import dumps
 
 from sanic.request import Request
+from sanic.log import logger
 from sanic.exceptions import Unauthorized, NotFound
 
 from dataclasses_jsonschema import JsonSchemaMeta, JsonSchemaMixin, ValidationError
@@ -12,10 +16,141 @@ from dataclasses_jsonschema import JsonSchemaMeta, JsonSchemaMixin, ValidationEr
 from yrest.tree import Tree, Email, Password, Phone
 from yrest.mongo import Mongo
 from yrest.ysanic import ySanic
-from yrest.auth import check_password_hash
-from yrest.utils import Ok, OkResult, OkListResult, ErrorMessage, get_parents_urls
+from yrest.utils import Ok, OkResult, OkListResult, ErrorMessage
+
+from pymongo import InsertOne, DeleteMany
+
+from actors import actor_cache
+from authz import grant, permission_matrix
+from documents import to_document
+from passwords import password_hasher
+from counters import bump, counted, new_counters
+from urls import url_chain
+from files import delete_files, file_info, file_doc_info, decode_data, download_url
+from pages import page, page_size, keyset_filter, keyset_page, next_cursor
+
+from rollups import activity
+from parameters import TransferRoleRequest, DelegationRequest, ChangePasswordRequest, UploadFilesRequest, SearchRequest, GetFileRequest, ActivityRequest
+
+async def hydrate_nodes(app, urls) -> Dict[str, Any]:
+  """Returns the nodes at urls, by url, fetched with a single query"""
+  urls = set(urls)
+  parts = [url.rsplit("/", 1) for url in urls if url != "/"]
+  query = {"$or": [{"path": {"$in": list({path or "/" for path, _ in parts})}, "slug": {"$in": list({slug for _, slug in parts})}}]}
+  if "/" in urls:
+    query["$or"].append({"path": ""})
+
+  nodes = {}
+  async for doc in app._table.find(query):
+    url = "/" if doc["path"] == "" else f"{doc['path'].rstrip('/')}/{doc['slug']}"
+    if url in urls and url not in nodes:
+      nodes[url] = getattr(app._models, doc["type"])(**doc)
+  return nodes
+
+async def messages_page(app, url: str, cursor: Optional[str], limit: int) -> Tuple[List[Any], Optional[str]]:
+  """Returns the messages at url older than cursor in chronological order and the cursor of the previous page"""
+  query = {"type": "Message", "path": url, **keyset_filter("date", cursor)}
+  docs = await app._table.find(query).sort([("date", -1), ("_id", -1)]).limit(limit).to_list(None)
+  return [app._models.Message(**doc) for doc in reversed(docs)], next_cursor(docs, "date", limit)
+
+async def count_by_child(collection, field: str, urls: List[str], match: Dict[str, Any]) -> Dict[str, int]:
+  """Counts the matched documents under each of urls, grouped by the url found in their ancestor_urls field"""
+  pipeline = [
+    {"$match": {field: {"$in": urls}, **match}},
+    {"$unwind": f"${field}"},
+    {"$match": {field: {"$in": urls}}},
+    {"$group": {"_id": f"${field}", "count": {"$sum": 1}}}
+  ]
+  return {doc["_id"]: doc["count"] async for doc in collection.aggregate(pipeline)}
+
+async def phases_by_child(table, urls: List[str]) -> Dict[str, Dict[str, int]]:
+  """Returns the total and finished phases grouped by the child's url"""
+  pipeline = [
+    {"$match": {"type": "Phase", "path": {"$in": urls}}},
+    {"$group": {"_id": "$path", "total": {"$sum": 1}, "finished": {"$sum": {"$cond": ["$finished", 1, 0]}}}}
+  ]
+  return {doc["_id"]: {"total": doc["total"], "finished": doc["finished"]} async for doc in table.aggregate(pipeline)}
+
+async def files_by_parent(app, urls: List[str]) -> Dict[str, int]:
+  """Returns the amount of files grouped by their parent's url"""
+  pipeline = [
+    {"$match": {"metadata.parent": {"$in": urls}}},
+    {"$group": {"_id": "$metadata.parent", "count": {"$sum": 1}}}
+  ]
+  return {doc["_id"]: doc["count"] async for doc in app._table.database["fs.files"].aggregate(pipeline)}
+
+async def children_with_stats(request: Request, parent, model: str) -> Dict[str, Any]:
+  """Returns the parent's children of the model with their stats computed in bulk"""
+  app = request.app
+  url = parent.get_url()
+  skip, limit = page(request)
+
+  cursor = app._table.find({"type": model, "path": url}).sort([("record", 1)]).skip(skip)
+  if limit:
+    cursor = cursor.limit(limit)
+  children = [getattr(app._models, doc["type"])(**doc) for doc in await cursor.to_list(None)]
+  if not children:
+    return {}
+
+  uncounted = [child.get_url() for child in children if not counted(child)]
+  if uncounted:
+    files, messages, activity, phases = await gather(
+      count_by_child(app._table.database["fs.files"], "metadata.ancestor_urls", uncounted, {}),
+      count_by_child(app._table, "ancestor_urls", uncounted, {"type": "Message"}),
+      count_by_child(app._backlog_table, "ancestor_urls", uncounted, {}),
+      phases_by_child(app._table, uncounted)
+    )
+
+  result = {}
+  for child in children:
+    obj = child.to_plain_dict()
+    if counted(child):
+      obj["stats"] = {
+        "files": child.counters.get("files", 0),
+        "messages": child.counters.get("messages", 0),
+        "activity": child.counters.get("activity", 0),
+        "phases": {"total": child.counters.get("phases", 0), "finished": child.counters.get("finished", 0)}
+      }
+    else:
+      child_url = child.get_url()
+      obj["stats"] = {
+        "files": files.get(child_url, 0),
+        "messages": messages.get(child_url, 0),
+        "activity": activity.get(child_url, 0),
+        "phases": phases.get(child_url, {"total": 0, "finished": 0})
+      }
+    result[child.slug] = obj
+
+  return result
+
+@dataclass
+class HasAncestors:
+  ancestor_urls: List[str] = field(default_factory = list)
+
+  async def create_child(self, child, *args, **kwargs):
+    if isinstance(child, HasAncestors):
+      child.ancestor_urls = url_chain(self.get_url())
+    if isinstance(child, HasCounters) and not child.counters:
+      child.counters = new_counters()
+    if isinstance(child, HashesPassword):
+      await child.hash_password()
+    return await super().create_child(child, *args, **kwargs)
+
+@dataclass
+class HashesPassword:
+  """Hashes the plain password of a new user before it's stored, whatever path stores it"""
+  async def hash_password(self):
+    if self.password and not getattr(self, "_password_hashed", False):
+      self.password = await password_hasher.hash(self.password)
+      self._password_hashed = True
 
-from parameters import TransferRoleRequest, DelegationRequest, ChangePasswordRequest, UploadFilesRequest, SearchRequest, GetFileRequest
+  async def create(self, *args, **kwargs):
+    await self.hash_password()
+    return await super().create(*args, **kwargs)
+
+@dataclass
+class HasCounters:
+  counters: Dict[str, Any] = field(default_factory = dict)
 
 @dataclass
 class HasInvitations:
@@ -39,13 +174,14 @@ class HasUsers:
 class DefinesSecurity:
   roles: List[str] = field(default_factory = list, metadata = {"model": "Role"})
   permissions: List[str] = field(default_factory = list, metadata = {"model": "Permission"})
+  security_hash: str = None
 
-  async def _rebuild_sec(self, app: ySanic):
+  async def _rebuild_sec(self, app: ySanic, force: bool = False):
     """Allows to maintain the security inline with the code"""
-    await self._rebuild_perms(app)
+    await self._rebuild_perms(app, force)
     await self._rebuild_roles(app)
 
-  async def _rebuild_perms(self, app: ySanic):
+  async def _rebuild_perms(self, app: ySanic, force: bool = False):
     """Allows to sync source code with its permissions objects in the database"""
     src_perms = set()
     for model, data in app._introspection.items():
@@ -57,24 +193,42 @@ class DefinesSecurity:
         for factory in data["factories"]:
           src_perms.add(f"{model}/create_{factory.lower()}")
 
-    perms = await self.children([app._models.Permission])
-    perms = {f"{perm.context}/{perm.name}": perm for perm in perms["permissions"]}
-    perms_set = set(perms.keys())
+    security_hash = sha1(dumps([sorted(src_perms), sorted(app.config["OPEN_ENDPOINTS"])]).encode("UTF-8")).hexdigest()
+    if not force and self.security_hash == security_hash:
+      return
 
-    for perm in (src_perms - perms_set):
-      parts = perm.split("/")
-      name = parts.pop()
-      context = "/".join(parts)
-      roles = [] if perm in app.config["OPEN_ENDPOINTS"] else ["admin"]
-      perm_obj = app._models.Permission(name = name, context = context, roles = roles)
-      await self.create_child(perm_obj, app._models)
+    url = self.get_url()
+    perms = {f"{doc['context']}/{doc['name']}": doc["slug"] async for doc in self._table.find({"type": "Permission", "path": url}, {"context": 1, "name": 1, "slug": 1})}
 
-    for perm in (perms_set - src_perms):
-      parts = perm.split("/")
-      name = parts.pop()
-      context = "/".join(parts)
-      perm_obj = await app._models.Permission.get(self._table, path = self.get_url(), name = name, context = context)
-      await perm_obj.delete(app._models)
+    missing = []
+    for perm in sorted(src_perms - perms.keys()):
+      context, name = perm.rsplit("/", 1)
+      roles = [] if perm in app.config["OPEN_ENDPOINTS"] else ["admin"]
+      missing.append(app._models.Permission(name = name, context = context, roles = roles, path = url, ancestor_urls = url_chain(url)))
+
+    # Bulk inserted documents must look like the ones create_child stores, otherwise create_child does the work
+    template = await self._table.find_one({"type": "Permission", "path": url})
+    docs = [to_document(perm_obj) for perm_obj in missing]
+    if docs and (not template or any(doc.keys() != template.keys() - {"_id"} for doc in docs)):
+      logger.info(f"Creating {len(missing)} permissions one by one as create_child's document shape isn't known yet")
+      for perm_obj in missing:
+        await self.create_child(perm_obj, app._models)
+      docs = []
+
+    requests = [InsertOne(doc) for doc in docs]
+    stale = [perms[perm] for perm in perms.keys() - src_perms]
+    if stale:
+      requests.append(DeleteMany({"type": "Permission", "path": url, "slug": {"$in": stale}}))
+
+    if requests:
+      await self._table.bulk_write(requests, ordered = False)
+
+    stored = [doc["slug"] async for doc in self._table.find({"type": "Permission", "path": url}, {"slug": 1})]
+    permissions = [slug for slug in self.permissions if slug in stored] + [slug for slug in stored if slug not in self.permissions]
+    await self._table.update_one(self._decompose_url(url), {"$set": {"permissions": permissions, "security_hash": security_hash}})
+    self.permissions = permissions
+    self.security_hash = security_hash
+    permission_matrix.invalidate()
 
   async def _rebuild_roles(self, app: ySanic):
     """Allows to sync system roles"""
@@ -91,7 +245,7 @@ class DefinesSecurity:
 
   async def rebuild_sec(self, request: Request) -> Ok:
     """Allows to rebuild the permissions and roles"""
-    self._rebuild_sec(request.app)
+    await self._rebuild_sec(request.app, force = True)
 
   async def get_roles(self, request: Request) -> OkListResult:
     """Returns the list of roles"""
@@ -133,8 +287,9 @@ class CanBeRemoved:
     """Removes the paper"""
     result = await request.app._generic_remover(request, self, actor)
 
-    perm_url = f"@{self.get_url()}$"
-    await self._table.update_many({"roles": {"$regex": perm_url}}, {"$pull": {"roles": {"$regex": perm_url}}})
+    url = self.get_url()
+    await self._table.update_many({"grants.scope": url}, {"$pull": {"grants": {"scope": url}}})
+    actor_cache.clear()
 
     return result
 
@@ -142,13 +297,37 @@ class CanBeRemoved:
 class CanBeRemovedWithFiles(CanBeRemoved):
   async def remove(self, request: Request, actor: "User") -> OkResult:
     """Remove the paper and its files"""
-    async for file in request.app._gridfs.find({"filename": {"$regex": f"^{self.get_url()}"}}):
-      await request.app._gridfs.delete(file._id)
+    database = self._table.database
+    query = {"metadata.ancestor_urls": self.get_url()}
+    removed = await self._removed_counters(database, query)
+    batch_size = request.app.config.get("FILES_DELETE_BATCH_SIZE", 1000)
+    background = request.app.config.get("FILES_BACKGROUND_DELETE", 0)
+    if background and await database["fs.files"].count_documents(query) > background:
+      request.app.add_task(delete_files(database, query, batch_size, label = f"Removing the files of {self.get_url()}"))
+    else:
+      await delete_files(database, query, batch_size)
 
     result = await super().remove(request, actor)
 
+    await bump(self._table, self.path, **{name: -amount for name, amount in removed.items()})
+
     return result
 
+  async def _removed_counters(self, database, files_query: Dict[str, Any]) -> Dict[str, int]:
+    """Returns what the subtree adds to its ancestors' counters"""
+    if counted(self):
+      return {name: self.counters.get(name, 0) for name in ("files", "bytes", "messages", "phases", "finished")}
+
+    url = self.get_url()
+    files, messages, phases = await gather(
+      database["fs.files"].aggregate([{"$match": files_query}, {"$group": {"_id": None, "files": {"$sum": 1}, "bytes": {"$sum": "$length"}}}]).to_list(None),
+      self._table.count_documents({"type": "Message", "ancestor_urls": url}),
+      self._table.aggregate([{"$match": {"type": "Phase", "ancestor_urls": url}}, {"$group": {"_id": None, "phases": {"$sum": 1}, "finished": {"$sum": {"$cond": ["$finished", 1, 0]}}}}]).to_list(None)
+    )
+    files = files[0] if files else {}
+    phases = phases[0] if phases else {}
+    return {"files": files.get("files", 0), "bytes": files.get("bytes", 0), "messages": messages, "phases": phases.get("phases", 0), "finished": phases.get("finished", 0)}
+
 @dataclass
 class HasContext:
   context: str
@@ -158,35 +337,37 @@ class HasRoles:
   roles: List[str] = field(default_factory = list)
 
   async def allows(self, actor, context) -> bool:
-    return not self.roles or (actor and set(actor.get_roles(context)) & set(self.roles))
+    table = getattr(self, "_table", None)
+    mask = await permission_matrix.get(table, self.context, self.name) if table is not None else None
+    return permission_matrix.allowed(actor, context, permission_matrix.mask(self.roles) if mask is None else mask)
 
 @dataclass
 class HasEmail:
   email: Email = field(metadata = JsonSchemaMeta(extensions = {"label": "Email"}))
 
+@dataclass
+class HasLastLogin:
+  last_login: datetime = None
+
 @dataclass
 class CanBeAuthenticated:
   password: Password = None
   roles: List[str] = field(default_factory = list)
+  grants: List[Dict[str, str]] = field(default_factory = list)
 
   def get_roles(self, context):
     roles = self.roles.copy()
     if self == context:
       roles.append("owner")
 
-    urls = get_parents_urls(context.get_url())
-    if urls:
-      for url in urls:
-        for role in self.roles:
-          if role.endswith(url):
-            roles.append(role.split('@')[0])
-            break
+    urls = set(url_chain(context.get_url()))
+    roles.extend(user_grant["role"] for user_grant in self.grants if user_grant["scope"] in urls)
 
     return roles
 
   async def change_password(self, request: Request, consume: ChangePasswordRequest) -> Ok:
     """Allows to change the actor's password"""
-    if not check_password_hash(self.password, consume.old):
+    if not await password_hasher.check(self.password, consume.old):
       return ErrorMessage("Bad old password", 401)
 
     await self.update(request.app._models, password = consume.new)
@@ -197,20 +378,7 @@ class HasProjects:
 
   async def get_projects(self, request: Request, actor) -> OkResult:
     """Returns the list of projects"""
-    children = await self.children([request.app._models.Project], sort = {"Project": {"$sort": {"record": 1}}})
-    result = {}
-    for child in children["projects"]:
-      obj = child.to_plain_dict()
-      child._table = self._table
-      url = child.get_url()
-      obj["stats"] = {}
-      obj["stats"]["files"] = len(await request.app._gridfs.find({"filename": {"$regex": f"^{url}"}}).to_list(None))
-      obj["stats"]["messages"] = len(await request.app._table.find({"type": "Message", "path": {"$regex": f"^{url}"}}).to_list(None))
-      obj["stats"]["activity"] = len(await request.app._table.find({"type": "Backlog", "runned_path": {"$regex": f"^{url}"}}).to_list(None))
-      obj["stats"]["phases"] = await child.phases_stats(request)
-      result[child.slug] = obj
-
-    return result
+    return await children_with_stats(request, self, "Project")
 
 @dataclass
 class HasRecords:
@@ -218,21 +386,7 @@ class HasRecords:
 
   async def get_records(self, request: Request) -> OkResult:
     """Returns the list of records"""
-    from sanic.log import logger
-    children = await self.children([request.app._models.Record], sort = {"Record": {"$sort": {"record": 1}}})
-    result = {}
-    for child in children["records"]:
-      obj = child.to_plain_dict()
-      child._table = self._table
-      url = child.get_url()
-      obj["stats"] = {}
-      obj["stats"]["files"] = len(await request.app._gridfs.find({"filename": {"$regex": f"^{url}"}}).to_list(None))
-      obj["stats"]["messages"] = len(await request.app._table.find({"type": "Message", "path": {"$regex": f"^{url}"}}).to_list(None))
-      obj["stats"]["activity"] = len(await request.app._table.find({"type": "Backlog", "runned_path": {"$regex": f"^{url}"}}).to_list(None))
-      obj["stats"]["phases"] = await child.phases_stats(request)
-      result[child.slug] = obj
-
-    return result
+    return await children_with_stats(request, self, "Record")
 
 @dataclass
 class HasCode:
@@ -249,6 +403,9 @@ class HasPhases:
 
   async def phases_stats(self, request: Request) -> OkResult:
     """Returns the total and finished phases"""
+    if counted(self):
+      return {"total": self.counters.get("phases", 0), "finished": self.counters.get("finished", 0)}
+
     match = {"$match": {"type": "Phase", "path": self.get_url()}}
     group = {"$group": {"_id": None, "total": {"$sum": 1}, "finished": {"$sum": {"$cond": ["$finished", 1, 0]}}}}
     stats = await request.app._table.aggregate([match, group]).to_list(None)
@@ -290,41 +447,38 @@ class HasStakeholders:
   async def get_stakeholders(self, request: Request) -> OkResult:
     """Returns the project's stakeholders"""
     my_url = self.get_url()
-    stakeholders = await request.app._models.User.gets(self._table, roles = {"$regex": f"@{my_url}$"})
+    stakeholders = await request.app._models.User.gets(self._table, **{"grants.scope": my_url})
     result = {}
     for stakeholder in stakeholders:
-      for rolepath in stakeholder.roles:
-        if rolepath.endswith(f'@{my_url}'):
-          role = rolepath.split('@')[0]
-          if role not in result.keys():
-            result[role] = []
-          result[role].append(stakeholder)
+      for user_grant in stakeholder.grants:
+        if user_grant["scope"] == my_url:
+          result.setdefault(user_grant["role"], []).append(stakeholder)
 
     return result
 
   async def transfer_role(self, request: Request, actor: "User", consume: TransferRoleRequest) -> OkListResult:
     """Transfer a role from the actor to the provided user"""
     url = self.get_url()
-    role = f"{consume.role}@{url}"
+    role = grant(consume.role, url)
     owner = await request.app._models.User.get(self._table, email = consume.owner)
-    if role not in owner.roles:
+    if role not in owner.grants:
       raise Unauthorized(f"{owner.name} has not {consume.role} @ {url}")
 
     newOwner = await request.app._models.User.get(self._table, email = consume.newOwner)
-    if role in newOwner.roles:
+    if role in newOwner.grants:
       raise ValidationError(f"{newOwner.name} has already {consume.role} @ {url}")
 
-    newOwner_roles = newOwner.roles
-    newOwner_roles.append(role)
-    owner_roles = owner.roles
-    owner_roles.pop(owner_roles.index(role))
+    newOwner_grants = newOwner.grants
+    newOwner_grants.append(role)
+    owner_grants = owner.grants
+    owner_grants.remove(role)
 
     async with await self._table.database.client.start_session() as s:
       async with s.start_transaction():
-        await newOwner.update(request.app._models, roles = newOwner_roles)
-        await owner.update(request.app._models, roles = owner_roles)
+        await newOwner.update(request.app._models, grants = newOwner_grants)
+        await owner.update(request.app._models, grants = owner_grants)
 
-    return {"newOwner": newOwner_roles, "exOwner": owner_roles}
+    return {"newOwner": newOwner_grants, "exOwner": owner_grants}
 
   async def give_role(self, request: Request, consume: DelegationRequest) -> OkResult:
     """Gives a role to the user in this position"""
@@ -332,11 +486,12 @@ class HasStakeholders:
     if not user:
       raise NotFound("The user can't be found")
 
-    roles = user.roles
-    roles.append(f"{consume.role}@{self.get_url()}")
-    await user.update(request.app._models, roles = roles)
+    grants = user.grants
+    if grant(consume.role, self.get_url()) not in grants:
+      grants.append(grant(consume.role, self.get_url()))
+      await user.update(request.app._models, grants = grants)
 
-    return roles
+    return grants
 
   async def withdraw_role(self, request: Request, consume: DelegationRequest) -> OkListResult:
     """Removes a role from the user in this position"""
@@ -344,111 +499,85 @@ class HasStakeholders:
     if not user:
       raise NotFound("The user can't be found")
 
-    roles = user.roles
-    roles.remove(f"{consume.role}@{self.get_url()}")
-    await user.update(request.app._models, roles = roles)
+    grants = user.grants
+    grants.remove(grant(consume.role, self.get_url()))
+    await user.update(request.app._models, grants = grants)
 
-    return roles
+    return grants
 
 @dataclass
 class HasFiles:
   async def get_files(self, request: Request) -> OkResult:
     """Returns the files' url list"""
-    stream = None
-    content_type = None
     files = {}
-    async for file in request.app._gridfs.find({"filename": {"$regex": f"^{self.get_url()}"}}):
-      content_type = file.metadata["contentType"]
-      stream = await file.read()
-      files[file.name] = {"stream": stream, "content_type": content_type}
+    async for file in request.app._gridfs.find({"metadata.ancestor_urls": self.get_url()}):
+      files[file.name] = file_info(file)
 
     return files
 
   async def upload_files(self, request: Request, consume: UploadFilesRequest) -> OkResult:
     """Allows to upload multiple files"""
     url = self.get_url()
-    result = {}
-    for file in consume.files:
+    limit = Semaphore(request.app.config.get("UPLOAD_CONCURRENCY", 4))
+
+    async def upload(file):
       file_url = f"{url}/{file['name']}"
-      metadata = {"contentType": file["content_type"], "parent": url}
-      await request.app._gridfs.upload_from_stream(filename = file_url, source = file["data"].encode("UTF-8"), metadata = metadata)
-      result[file_url] = {"content_type": file["content_type"], "stream": file["data"]}
-    return result
+      metadata = {"contentType": file["content_type"], "parent": url, "ancestor_urls": url_chain(url)}
+      source = decode_data(file["data"])
+      async with limit:
+        await request.app._gridfs.upload_from_stream(filename = file_url, source = source, metadata = metadata)
+      return {"filename": file_url, "content_type": file["content_type"], "length": len(source), "url": download_url(file_url)}
+
+    uploaded = await gather(*[upload(file) for file in consume.files])
+    await bump(self._table, url, files = len(uploaded), bytes = sum(file["length"] for file in uploaded))
+
+    return {file["filename"]: file for file in uploaded}
 
   async def files_amount(self, request: Request) -> int:
     """Returns the number of files"""
-    files = await request.app._gridfs.find({"filename": {"$regex": f"^{self.get_url()}"}}).to_list(None)
+    if counted(self):
+      return self.counters.get("files", 0)
+
+    files = await request.app._gridfs.find({"metadata.ancestor_urls": self.get_url()}).to_list(None)
     return len(files)
 
 @dataclass
 class AggregatesFiles:
   async def files_by_project(self, request: Request) -> OkResult:
     """Returns the files by project"""
-    stream = None
-    content_type = None
     files = {}
+    async for file in request.app._gridfs.find({"metadata.ancestor_urls": self.get_url()}).sort("uploadDate", -1):
+      files.setdefault(file.metadata["parent"], {"obj": None, "files": {}})["files"][file.name] = {"stream": await file.read(), "content_type": file.metadata["contentType"]}
 
-    async for file in request.app._gridfs.find({"filename": {"$regex": f"^{self.get_url()}"}}).sort("uploadDate", -1):
-      content_type = file.metadata["contentType"]
-      stream = await file.read()
-      if file.metadata["parent"] not in files.keys():
-        parent = await self._table.find_one(self.__class__._decompose_url(file.metadata["parent"]))
-        parentObj = getattr(request.app._models, parent["type"])(**parent)
-        files[file.metadata["parent"]] = {"obj": parentObj.to_plain_dict(), "files": {}}
-      files[file.metadata["parent"]]["files"][file.name] = {"stream": stream, "content_type": content_type}
+    parents = await hydrate_nodes(request.app, files.keys())
+    for url, project in files.items():
+      parent = parents.get(url)
+      project["obj"] = parent.to_plain_dict() if parent else None
 
     return files
 
+  async def files_by_project_page(self, request: Request) -> OkResult:
+    """Returns a page of the files' metadata by project"""
+    keyset, limit = keyset_page(request, "uploadDate")
+    query = {"metadata.ancestor_urls": self.get_url(), **keyset}
+    docs = await request.app._table.database["fs.files"].find(query).sort([("uploadDate", -1), ("_id", -1)]).limit(limit).to_list(None)
+
+    parents = await hydrate_nodes(request.app, [doc["metadata"]["parent"] for doc in docs])
+    files = {}
+    for doc in docs:
+      url = doc["metadata"]["parent"]
+      if url not in files.keys():
+        parent = parents.get(url)
+        files[url] = {"obj": parent.to_plain_dict() if parent else None, "files": {}}
+      files[url]["files"][doc["filename"]] = file_doc_info(doc)
+
+    return {"projects": files, "next": next_cursor(docs, "uploadDate", limit)}
+
 @dataclass
 class IsSearchable:
   async def search(self, request: Request, consume: SearchRequest) -> OkResult:
     """Allows to search for contents"""
-    if consume.search:
-      search_query = {
-        "multi_match": {
-          "fields": ["name", "description", "code", "address", "areas", "themes", "tags", "filename" ],
-          "query": consume.search,
-          "fuzziness": "AUTO"
-        }
-      }
-    else:
-      search_query = None
-
-    if consume.start_date and consume.end_date:
-      date_query = {
-        "range": {
-          "record": {"gte": consume.start_date + 'T00:00:00', "lte": consume.end_date + 'T23:59:59'}
-        }
-      }
-    elif consume.start_date:
-      date_query = {
-        "range": {
-          "record": {"gte": consume.start_date + 'T00:00:00', "lte": consume.start_date + 'T23:59:59'}
-        }
-      }
-    else:
-      date_query = None
-
-    if search_query and date_query:
-      query = {
-        "query": {
-          "bool": {
-            "must": search_query,
-            "filter": [ date_query ]
-          }
-        }
-      }
-    elif search_query:
-      query = {
-        "query": search_query
-      }
-    elif date_query:
-      query = {
-        "query": date_query
-      }
-
-    result = await request.app._es.search(index = "gd.gd,gd.fs.files", body = query)
-    return result["hits"]
+    return await request.app._search.search(consume)
 
   async def search_file(self, request: Request, consume: GetFileRequest) -> OkResult:
     """Returns the file by its name"""
@@ -457,8 +586,7 @@ class IsSearchable:
       parentUrl = PurePath(file.metadata["parent"])
       parentDoc = await request.app._table.find_one({"path": str(parentUrl.parent), "slug": parentUrl.name})
       parent = getattr(request.app._models, parentDoc["type"])(**parentDoc)
-      stream = await file.read()
-      return {"filename": file.filename, "content_type": file.metadata["contentType"], "stream": stream, "parent": parent.to_plain_dict()}
+      return dict(file_info(file), parent = parent.to_plain_dict())
     else:
       return None
 @dataclass
@@ -477,22 +605,62 @@ class HasMessages:
     """Returns the list of messages"""
     result = await self.children([request.app._models.Message])
     return [child.to_plain_dict() for child in result["messages"]]
-    # return {child.slug: child.to_plain_dict() for child in result["messages"]}
+
+  async def get_messages_page(self, request: Request) -> OkResult:
+    """Returns a page of the latest messages"""
+    limit = page_size(request.args.get("limit"), request.app.config)
+    messages, before = await messages_page(request.app, self.get_url(), request.args.get("before"), limit)
+    return {"messages": [message.to_plain_dict() for message in messages], "before": before}
 
 @dataclass
 class AggregatesMessages:
   async def msgs_by_project(self, request: Request) -> OkResult:
     """Returns the messages aggregate by project"""
-    msgs = await request.app._models.Message.gets(self._table, path = {"$regex": f"^{self.get_url()}"}, sort = [("date", -1)])
+    docs = await self._table.find({"type": "Message", "ancestor_urls": self.get_url()}).sort([("date", -1), ("_id", -1)]).to_list(None)
+    parents = await hydrate_nodes(request.app, [doc["path"] for doc in docs])
     result = {}
-    for msg in msgs:
+    for doc in docs:
+      msg = request.app._models.Message(**doc)
       if msg.path not in result.keys():
-        parent = await self._table.find_one(self.__class__._decompose_url(msg.path))
-        parentObj = getattr(request.app._models, parent["type"])(**parent)
-        result[msg.path] = {"obj": parentObj.to_plain_dict(), "msgs": {}}
+        parent = parents.get(msg.path)
+        result[msg.path] = {"obj": parent.to_plain_dict() if parent else None, "msgs": {}}
       result[msg.path]["msgs"][msg.get_url()] = msg
     return result
 
+  async def msgs_by_project_page(self, request: Request) -> OkResult:
+    """Returns a page of the messages aggregate by project"""
+    keyset, limit = keyset_page(request, "date")
+    match = {"type": "Message", "ancestor_urls": self.get_url(), **keyset}
+    try:
+      per_project = int(request.args.get("per_project", 0))
+    except (TypeError, ValueError):
+      per_project = 0
+    if per_project > 0:
+      pipeline = [
+        {"$match": match},
+        {"$sort": {"date": -1, "_id": -1}},
+        {"$group": {"_id": "$path", "msgs": {"$push": "$$ROOT"}}},
+        {"$project": {"msgs": {"$slice": ["$msgs", per_project]}}},
+        {"$unwind": "$msgs"},
+        {"$replaceRoot": {"newRoot": "$msgs"}},
+        {"$sort": {"date": -1, "_id": -1}},
+        {"$limit": limit}
+      ]
+      docs = await self._table.aggregate(pipeline).to_list(None)
+    else:
+      docs = await self._table.find(match).sort([("date", -1), ("_id", -1)]).limit(limit).to_list(None)
+
+    parents = await hydrate_nodes(request.app, [doc["path"] for doc in docs])
+    result = {}
+    for doc in docs:
+      msg = request.app._models.Message(**doc)
+      if msg.path not in result.keys():
+        parent = parents.get(msg.path)
+        result[msg.path] = {"obj": parent.to_plain_dict() if parent else None, "msgs": {}}
+      result[msg.path]["msgs"][msg.get_url()] = msg
+
+    return {"projects": result, "next": next_cursor(docs, "date", limit)}
+
 @dataclass
 class HasMessage:
   message: str
@@ -503,11 +671,15 @@ class ShouldBeFinished:
 
   async def finish(self, request: Request, actor: "User") ->OkResult:
     """Mark as finished"""
+    already = bool(self.finished)
     await self.update(request.app._models, finished = datetime.utcnow())
+    if not already:
+      await bump(self._table, self.path, finished = 1)
 
-    roles = actor.roles
-    roles.append(f"participant@{self.get_url()}")
-    await actor.update(request.app._models, roles = roles)
+    grants = actor.grants
+    if grant("participant", self.get_url()) not in grants:
+      grants.append(grant("participant", self.get_url()))
+      await actor.update(request.app._models, grants = grants)
 
     return {"finished": self.finished.isoformat(), "participant": actor.slug}
 
@@ -515,10 +687,24 @@ class ShouldBeFinished:
 class HasBacklog:
   async def get_logs(self, request: Request) -> OkListResult:
     """Returns the backlog's entries"""
-    docs = await self._table.find({"type": "Backlog", "runned_path": {"$regex": f"^{self.get_url()}"}}).sort("date", -1).to_list(250)
+    docs = await request.app._backlog_table.find({"ancestor_urls": self.get_url()}).sort([("date", -1), ("_id", -1)]).to_list(250)
     backlog = request.app._models.Backlog
-    result = [backlog(**doc) for doc in docs]
-    return result
+    return [backlog(**doc) for doc in docs]
+
+  async def get_logs_page(self, request: Request) -> OkResult:
+    """Returns a page of the backlog's entries"""
+    keyset, limit = keyset_page(request, "date")
+    docs = await request.app._backlog_table.find({"ancestor_urls": self.get_url(), **keyset}).sort([("date", -1), ("_id", -1)]).limit(limit).to_list(None)
+    backlog = request.app._models.Backlog
+    return {"logs": [backlog(**doc) for doc in docs], "next": next_cursor(docs, "date", limit)}
+
+@dataclass
+class HasActivity:
+  async def get_activity(self, request: Request, consume: ActivityRequest) -> OkResult:
+    """Returns the activity by aspect between two dates"""
+    end = consume.end_date or datetime.utcnow()
+    start = consume.start_date or end - timedelta(days = 30)
+    return await activity(request.app._activity_table, self.get_url(), start, end, consume.granularity)
 
 @dataclass
 class HasPath:
@@ -538,20 +724,22 @@ class HasAspect:
 class ShouldEmitNewsAggregations:
   async def get_news(self, request: Request, actor) -> OkResult:
     """Returns the aggregation of the new activity"""
-    last = await request.app._models.Backlog.get(self._table, aspect = "auth", user =  actor.email, sort = [("date", -1)])
-
-    if last:
-      url = self.get_url()
-      # files = await request.app._gridfs.find({"filename": {"$regex": f"^{url}"}, "uploadDate": {"$gte": last.date}}).to_list(None)
-      files = await request.app._gridfs.find({"filename": {"$regex": f"^{url}"}}).to_list(None)
-      messages = await request.app._table.find({"type": "Message", "path": {"$regex": f"^{url}"}, "date": {"$gte": last.date}}).to_list(None)
-      activity = await request.app._table.find({"type": "Backlog", "runned_path": {"$regex": f"^{url}"}, "date": {"$gte": last.date}}).to_list(None)
-    else:
-      files = []
-      messages = []
-      activity = []
+    since = getattr(actor, "last_login", None)
+    if not since:
+      last = await request.app._models.Backlog.get(request.app._backlog_table, aspect = "auth", user =  actor.email, sort = [("date", -1)])
+      since = last.date if last else None
+
+    if not since:
+      return {"files": 0, "messages": 0, "activity": 0}
+
+    url = self.get_url()
+    files, messages, activity = await gather(
+      request.app._table.database["fs.files"].count_documents({"metadata.ancestor_urls": url, "uploadDate": {"$gte": since}}),
+      request.app._table.count_documents({"type": "Message", "ancestor_urls": url, "date": {"$gte": since}}),
+      request.app._backlog_table.count_documents({"ancestor_urls": url, "date": {"$gte": since}})
+    )
 
-    return {"files": len(files), "messages": len(messages), "activity": len(activity)}
+    return {"files": files, "messages": messages, "activity": activity}
 
 @dataclass
 class UpdateRequest(JsonSchemaMixin, HasTags, HasAddress, HasDeadline, ShouldBeRegistrable, HasCode, HasDescription):
@@ -0,0 +1,159 @@
+from base64 import b64decode
+from pathlib import PurePath
+from re import compile as re_compile
+from typing import Any, Dict, List, Optional, Tuple
+
+from sanic.log import logger
+
+DOWNLOAD_PREFIX = "/download"
+UPLOAD_PREFIX = "/upload"
+MAX_HEADERS_SIZE = 16384
+FILENAME_RE = re_compile(r'filename="?([^";]+)"?')
+
+async def delete_files(database, query: Dict[str, Any], batch_size: int = 1000, label: Optional[str] = None) -> int:
+  """Removes the GridFS files that match query and their chunks, batch_size files per round trip"""
+  deleted = 0
+  while True:
+    ids = [doc["_id"] for doc in await database["fs.files"].find(query, {"_id": 1}).limit(batch_size).to_list(None)]
+    if not ids:
+      return deleted
+
+    await database["fs.files"].delete_many({"_id": {"$in": ids}})
+    await database["fs.chunks"].delete_many({"files_id": {"$in": ids}})
+    deleted += len(ids)
+    if label:
+      logger.info(f"{label}: {deleted} files removed")
+
+def download_url(filename: str) -> str:
+  return f"{DOWNLOAD_PREFIX}{filename}"
+
+def file_etag(file) -> str:
+  return f'"{file._id}-{file.length}"'
+
+def file_info(file) -> Dict[str, Any]:
+  """Returns the file's metadata without its content"""
+  return {
+    "filename": file.filename,
+    "content_type": file.metadata["contentType"],
+    "length": file.length,
+    "upload_date": file.upload_date.isoformat(),
+    "url": download_url(file.filename)
+  }
+
+def file_doc_info(doc: Dict[str, Any]) -> Dict[str, Any]:
+  """Returns the metadata of a fs.files document"""
+  return {
+    "filename": doc["filename"],
+    "content_type": doc["metadata"]["contentType"],
+    "length": doc["length"],
+    "upload_date": doc["uploadDate"].isoformat(),
+    "url": download_url(doc["filename"])
+  }
+
+def parse_range(header: Optional[str], length: int) -> Optional[Tuple[int, int]]:
+  """Returns the inclusive byte range requested by the Range header, None to serve the whole file"""
+  if not header or not header.startswith("bytes=") or "," in header:
+    return None
+
+  start, _, end = header[6:].strip().partition("-")
+  try:
+    if not start:
+      suffix = int(end)
+      if suffix <= 0:
+        raise ValueError("Empty suffix range")
+      return max(length - suffix, 0), length - 1
+
+    start = int(start)
+    end = min(int(end), length - 1) if end else length - 1
+  except ValueError:
+    raise ValueError(f"Invalid range: {header}")
+
+  if start >= length or start > end:
+    raise ValueError(f"Unsatisfiable range: {header}")
+
+  return start, end
+
+def decode_data(data: str) -> bytes:
+  """Returns the bytes of a plain or base64 data url encoded file"""
+  if data.startswith("data:") and ";base64," in data:
+    return b64decode(data.split(";base64,", 1)[1])
+  return data.encode("UTF-8")
+
+def multipart_boundary(content_type: str) -> Optional[bytes]:
+  mimetype, _, params = content_type.partition(";")
+  if mimetype.strip().lower() != "multipart/form-data":
+    return None
+
+  for param in params.split(";"):
+    key, _, value = param.strip().partition("=")
+    if key.lower() == "boundary" and value:
+      return value.strip('"').encode("latin-1")
+  return None
+
+def disposition_filename(disposition: str) -> Optional[str]:
+  match = FILENAME_RE.search(disposition)
+  return PurePath(match.group(1)).name if match else None
+
+class MultipartReader:
+  """Incremental multipart/form-data parser fed with the request body's chunks
+
+  feed returns a list of ("headers", dict), ("data", bytes) and ("end", None) events"""
+  def __init__(self, boundary: bytes):
+    self._delimiter = b"\r\n--" + boundary
+    self._buffer = b"\r\n"
+    self._state = "preamble"
+
+  def feed(self, data: bytes) -> List[Tuple[str, Any]]:
+    self._buffer += data
+    events = []
+    while True:
+      if self._state == "preamble":
+        index = self._buffer.find(self._delimiter)
+        if index < 0:
+          self._buffer = self._buffer[-len(self._delimiter):]
+          return events
+        self._buffer = self._buffer[index + len(self._delimiter):]
+        self._state = "boundary"
+      elif self._state == "boundary":
+        if len(self._buffer) < 2:
+          return events
+        if self._buffer.startswith(b"--"):
+          self._state = "done"
+          self._buffer = b""
+          return events
+        if not self._buffer.startswith(b"\r\n"):
+          raise ValueError("Malformed multipart boundary")
+        self._buffer = self._buffer[2:]
+        self._state = "headers"
+      elif self._state == "headers":
+        index = self._buffer.find(b"\r\n\r\n")
+        if index < 0:
+          if len(self._buffer) > MAX_HEADERS_SIZE:
+            raise ValueError("Multipart headers are too large")
+          return events
+        headers = {}
+        for line in self._buffer[:index].decode("UTF-8").split("\r\n"):
+          name, _, value = line.partition(":")
+          headers[name.strip().lower()] = value.strip()
+        self._buffer = self._buffer[index + 4:]
+        self._state = "body"
+        events.append(("headers", headers))
+      elif self._state == "body":
+        index = self._buffer.find(self._delimiter)
+        if index < 0:
+          keep = len(self._delimiter) - 1
+          if len(self._buffer) > keep:
+            events.append(("data", self._buffer[:-keep]))
+            self._buffer = self._buffer[-keep:]
+          return events
+        if index:
+          events.append(("data", self._buffer[:index]))
+        events.append(("end", None))
+        self._buffer = self._buffer[index + len(self._delimiter):]
+        self._state = "boundary"
+      else:
+        return events
+
+  @property
+  def done(self) -> bool:
+    return self._state == "done"
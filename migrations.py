@@ -10,6 +10,10 @@ def table():
   modul = Production if 'SANIC_PRODUCTION_MODE' in environ else Development
   return MongoClient(modul.MONGO_URI)[modul.MONGO_DB][modul.MONGO_DB]
 
+def backlog_table():
+  modul = Production if 'SANIC_PRODUCTION_MODE' in environ else Development
+  return table().database[modul.BACKLOG_COLLECTION]
+
 def url(obj):
   if obj["path"] == "":
     return "/"
@@ -44,6 +48,163 @@ def addRequesters():
     with open('requesters.json', 'w') as f:
       f.write(dumps(result, indent = 2))
 
+def replayBacklogSpill():
+  from json import loads
+  from os import remove
+  from datetime import datetime
+  thetable = backlog_table()
+  path = (Production if 'SANIC_PRODUCTION_MODE' in environ else Development).BACKLOG_SPILL_PATH
+  with open(path) as f:
+    docs = [loads(line) for line in f if line.strip()]
+  for doc in docs:
+    doc["date"] = datetime.fromisoformat(doc["date"])
+    doc.pop("_id", None)
+  if docs:
+    thetable.insert_many(docs, ordered = False)
+  remove(path)
+
+def rebuildCounters():
+  from collections import defaultdict
+  from pymongo import UpdateOne
+  from counters import COUNTED_TYPES, COUNTERS, COUNTERS_VERSION
+  from urls import url_chain
+  thetable = table()
+  totals = defaultdict(lambda: dict.fromkeys(COUNTERS, 0))
+  last = {}
+
+  def add(node_url, **amounts):
+    for node in url_chain(node_url):
+      for name, amount in amounts.items():
+        totals[node][name] += amount
+
+  for doc in thetable.database["fs.files"].aggregate([{"$group": {"_id": "$metadata.parent", "files": {"$sum": 1}, "bytes": {"$sum": "$length"}}}]):
+    if doc["_id"]:
+      add(doc["_id"], files = doc["files"], bytes = doc["bytes"])
+  for doc in thetable.aggregate([{"$match": {"type": "Message"}}, {"$group": {"_id": "$path", "messages": {"$sum": 1}}}]):
+    add(doc["_id"], messages = doc["messages"])
+  for doc in thetable.aggregate([{"$match": {"type": "Phase"}}, {"$group": {"_id": "$path", "phases": {"$sum": 1}, "finished": {"$sum": {"$cond": ["$finished", 1, 0]}}}}]):
+    add(doc["_id"], phases = doc["phases"], finished = doc["finished"])
+  for doc in backlog_table().aggregate([{"$group": {"_id": "$runned_path", "activity": {"$sum": 1}, "last": {"$max": "$date"}}}]):
+    add(doc["_id"], activity = doc["activity"])
+    for node in url_chain(doc["_id"]):
+      last[node] = max(last.get(node, doc["last"]), doc["last"])
+
+  requests = []
+  for obj in thetable.find({"type": {"$in": COUNTED_TYPES}}, {"path": 1, "slug": 1}):
+    node = url(obj)
+    counters = dict(totals[node], last_activity = last.get(node), version = COUNTERS_VERSION)
+    requests.append(UpdateOne({"_id": obj["_id"]}, {"$set": {"counters": counters}}))
+    if len(requests) == 1000:
+      thetable.bulk_write(requests, ordered = False)
+      requests = []
+  if requests:
+    thetable.bulk_write(requests, ordered = False)
+
+def addAncestors(batch = 1000):
+  from pymongo import UpdateOne
+  from urls import url_chain
+  thetable = table()
+
+  def backfill(collection, missing, ancestors_of):
+    last = None
+    while True:
+      query = dict(missing, **({"_id": {"$gt": last}} if last else {}))
+      docs = list(collection.find(query).sort("_id", 1).limit(batch))
+      if not docs:
+        break
+      collection.bulk_write([UpdateOne({"_id": doc["_id"]}, ancestors_of(doc)) for doc in docs], ordered = False)
+      last = docs[-1]["_id"]
+      print(f"{collection.name}: backfilled up to {last}")
+
+  # ancestor_urls was first stored as ancestors, which hid Tree.ancestors()
+  def node_ancestors(doc):
+    if doc.get("type") == "Backlog" or "runned_path" in doc:
+      return {"$set": {"ancestor_urls": url_chain(doc["runned_path"])}, "$unset": {"ancestors": ""}}
+    return {"$set": {"ancestor_urls": url_chain(doc["path"]) if doc.get("path") else []}, "$unset": {"ancestors": ""}}
+
+  backfill(thetable, {"ancestor_urls": {"$exists": False}}, node_ancestors)
+  backfill(backlog_table(), {"ancestor_urls": {"$exists": False}}, node_ancestors)
+  backfill(thetable.database["fs.files"], {"metadata.ancestor_urls": {"$exists": False}}, lambda doc: {"$set": {"metadata.ancestor_urls": url_chain(doc["metadata"]["parent"])}, "$unset": {"metadata.ancestors": ""}})
+
+def moveBacklog(batch = 1000):
+  from pymongo.errors import BulkWriteError
+  from urls import url_chain
+  thetable = table()
+  backlog = backlog_table()
+  moved = 0
+  while True:
+    docs = list(thetable.find({"type": "Backlog"}).sort("_id", 1).limit(batch))
+    if not docs:
+      break
+    for doc in docs:
+      doc.pop("ancestors", None)
+      doc.setdefault("ancestor_urls", url_chain(doc["runned_path"]))
+    try:
+      backlog.insert_many(docs, ordered = False)
+    except BulkWriteError as e:
+      if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+        raise
+    thetable.delete_many({"_id": {"$in": [doc["_id"] for doc in docs]}})
+    moved += len(docs)
+    print(f"Moved {moved} backlog entries")
+
+def rebuildRollups(batch = 1000):
+  from collections import defaultdict
+  from rollups import GRANULARITIES, rollup_upsert
+  from urls import url_chain
+  activity = table().database[(Production if 'SANIC_PRODUCTION_MODE' in environ else Development).ACTIVITY_COLLECTION]
+  amounts = defaultdict(lambda: defaultdict(int))
+  for granularity in GRANULARITIES:
+    bucket = {"$dateFromParts": {"year": {"$year": "$date"}, "month": {"$month": "$date"}, "day": {"$dayOfMonth": "$date"}, "hour": {"$hour": "$date"} if granularity == "hour" else 0}}
+    for doc in backlog_table().aggregate([{"$group": {"_id": {"path": "$runned_path", "aspect": "$aspect", "bucket": bucket}, "amount": {"$sum": 1}}}], allowDiskUse = True):
+      for node in url_chain(doc["_id"]["path"]):
+        amounts[(node, granularity, doc["_id"]["bucket"])][doc["_id"]["aspect"]] += doc["amount"]
+
+  activity.delete_many({})
+  requests = [rollup_upsert(node, granularity, bucket, aspects) for (node, granularity, bucket), aspects in amounts.items()]
+  for index in range(0, len(requests), batch):
+    activity.bulk_write(requests[index:index + batch], ordered = False)
+
+def convertGrants(batch = 1000):
+  from pymongo import UpdateOne
+  thetable = table()
+  last = None
+  converted = 0
+  while True:
+    query = dict({"type": "User", "roles": {"$regex": "@"}}, **({"_id": {"$gt": last}} if last else {}))
+    docs = list(thetable.find(query, {"roles": 1, "grants": 1}).sort("_id", 1).limit(batch))
+    if not docs:
+      break
+
+    requests = []
+    for doc in docs:
+      grants = doc.get("grants", [])
+      for role in doc["roles"]:
+        if "@" in role:
+          name, scope = role.split("@", 1)
+          if {"role": name, "scope": scope} not in grants:
+            grants.append({"role": name, "scope": scope})
+      requests.append(UpdateOne({"_id": doc["_id"]}, {"$set": {"roles": [role for role in doc["roles"] if "@" not in role], "grants": grants}}))
+    thetable.bulk_write(requests, ordered = False)
+    last = docs[-1]["_id"]
+    converted += len(docs)
+    print(f"Converted the grants of {converted} users")
+
+  thetable.create_index([("grants.scope", 1), ("grants.role", 1)])
+  thetable.create_index("grants.role")
+
+def hashPlainPasswords():
+  from yrest.auth import generate_password_hash
+  from pymongo import UpdateOne
+  thetable = table()
+  requests = []
+  for doc in thetable.find({"type": "User", "password": {"$exists": True, "$ne": None}}, {"password": 1}):
+    if not doc["password"].startswith("pbkdf2:"):
+      requests.append(UpdateOne({"_id": doc["_id"]}, {"$set": {"password": generate_password_hash(doc["password"])}}))
+  if requests:
+    thetable.bulk_write(requests, ordered = False)
+  print(f"Hashed {len(requests)} plain passwords")
+
 if __name__ == "__main__":
   parser = ArgumentParser()
   parser.add_argument("action", help = "Run the specified action")
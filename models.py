@@ -1,3 +1,4 @@
+from asyncio import gather
 from typing import Any, Union, Optional, Dict, Tuple
 from dataclasses import dataclass
 from datetime import datetime
@@ -9,9 +10,14 @@ from dataclasses_jsonschema import JsonSchemaMixin
 from yrest.tree import Tree
 from yrest.mongo import Mongo
 from yrest.ysanic import yJSONEncoder
-from yrest.auth import Auth, IsAuth
-
-from features import HasInvitations, HasUsers, DefinesSecurity, HasDescription, HasName, CanBeRemoved, CanBeRemovedWithFiles, UsedBySystemOnly, SystemNeedsIt, HasRoles, HasContext, HasEmail, CanBeAuthenticated, HasProjects, HasRecords, HasCode, HasPhases, ShouldBeRegistrable, HasDeadline, HasAddress, HasTags, HasStakeholders, HasFiles, IsSearchable, HasMessages, HasMessage, IsTemporalyMarked, FromUser, ShouldBeFinished, HasBacklog, HasPath, HasAspect, ShouldEmitNewsAggregations, AggregatesFiles, AggregatesMessages, CanBeUpdated, IsCancelable, UpdateRequest, HasRequester, HasDepartment, HasNIF, HasPhone, HasRequesterType, HasRequesterSubtype, ShouldBeResolved
+from yrest.auth import IsAuth
+
+from actors import actor_cache
+from authz import permission_matrix
+from passwords import password_hasher
+from features import phases_by_child, files_by_parent
+from counters import bump, counted
+from features import HasAncestors, HashesPassword, HasCounters, HasLastLogin, HasActivity, HasInvitations, HasUsers, DefinesSecurity, HasDescription, HasName, CanBeRemoved, CanBeRemovedWithFiles, UsedBySystemOnly, SystemNeedsIt, HasRoles, HasContext, HasEmail, CanBeAuthenticated, HasProjects, HasRecords, HasCode, HasPhases, ShouldBeRegistrable, HasDeadline, HasAddress, HasTags, HasStakeholders, HasFiles, IsSearchable, HasMessages, HasMessage, IsTemporalyMarked, FromUser, ShouldBeFinished, HasBacklog, HasPath, HasAspect, ShouldEmitNewsAggregations, AggregatesFiles, AggregatesMessages, CanBeUpdated, IsCancelable, UpdateRequest, HasRequester, HasDepartment, HasNIF, HasPhone, HasRequesterType, HasRequesterSubtype, ShouldBeResolved
 from parameters import UpdatePermissionRequest
 from yrest.utils import  OkResult, OkListResult, can_crash, ErrorMessage
 
@@ -19,7 +25,7 @@ class SystemNeedsItException(Exception):
   pass
 
 @dataclass
-class Group(JsonSchemaMixin, Mongo, Tree, IsAuth, AggregatesMessages, AggregatesFiles, ShouldEmitNewsAggregations, HasBacklog, IsSearchable, HasInvitations, HasUsers, DefinesSecurity, HasRecords, HasProjects, HasDescription, HasName):
+class Group(HasAncestors, JsonSchemaMixin, Mongo, Tree, HasCounters, IsAuth, AggregatesMessages, AggregatesFiles, ShouldEmitNewsAggregations, HasActivity, HasBacklog, IsSearchable, HasInvitations, HasUsers, DefinesSecurity, HasRecords, HasProjects, HasDescription, HasName):
   async def index(self, request: Request) -> OkResult:
     """Returns the group's data"""
     ancests = await self.ancestors(request.app._models)
@@ -29,12 +35,20 @@ class Group(JsonSchemaMixin, Mongo, Tree, IsAuth, AggregatesMessages, Aggregates
   async def get_children(self, request: Request) ->OkResult:
     """Returns the list of projects and records"""
     children = await self._table.find({"$or": [{"type": "Project"}, {"type": "Record"}], "path": self.get_url()}).sort([("record", 1)]).to_list(None)
+    children = [getattr(request.app._models, child["type"])(**child) for child in children]
+    urls = [child.get_url() for child in children if not counted(child)]
+    phases, files = await gather(phases_by_child(self._table, urls), files_by_parent(request.app, urls)) if urls else ({}, {})
+
     result = {}
-    for child in children:
-      childObj = getattr(request.app._models, child["type"])(**child)
+    for childObj in children:
+      url = childObj.get_url()
       data = childObj.to_plain_dict()
-      data["phaseStats"] = await childObj.phases_stats(request)
-      data["fileStats"] = await childObj.files_amount(request)
+      if counted(childObj):
+        data["phaseStats"] = {"total": childObj.counters.get("phases", 0), "finished": childObj.counters.get("finished", 0)}
+        data["fileStats"] = childObj.counters.get("files", 0)
+      else:
+        data["phaseStats"] = phases.get(url, {"total": 0, "finished": 0})
+        data["fileStats"] = files.get(url, 0)
 
       result[childObj.slug] = data
 
@@ -60,7 +74,7 @@ class Group(JsonSchemaMixin, Mongo, Tree, IsAuth, AggregatesMessages, Aggregates
   #   return areas
 
 @dataclass
-class Role(JsonSchemaMixin, Mongo, Tree, CanBeRemoved, UsedBySystemOnly, SystemNeedsIt, HasDescription, HasName):
+class Role(HasAncestors, JsonSchemaMixin, Mongo, Tree, CanBeRemoved, UsedBySystemOnly, SystemNeedsIt, HasDescription, HasName):
   __x_schema__ = {"form": ["name", "description"]}
 
   @can_crash(SystemNeedsItException, code = 405)
@@ -71,13 +85,13 @@ class Role(JsonSchemaMixin, Mongo, Tree, CanBeRemoved, UsedBySystemOnly, SystemN
 
     result = await request.app._generic_remover(request, self, actor)
 
-    role_prefix = f"^{self.slug}@"
-    await self._table.update_many({"roles": {"$regex": role_prefix}}, {"$pull": {"roles": {"$regex": role_prefix}}})
+    await self._table.update_many({"grants.role": self.slug}, {"$pull": {"grants": {"role": self.slug}}})
+    actor_cache.clear()
 
     return result
 
 @dataclass
-class Permission(JsonSchemaMixin, Mongo, Tree, HasRoles, HasContext, HasName):
+class Permission(HasAncestors, JsonSchemaMixin, Mongo, Tree, HasRoles, HasContext, HasName):
   def __sluger__(self, values: Optional[Dict[str, Any]] = None, fields: bool = False) -> Union[Tuple, str]:
     if fields:
       return ("context", "name")
@@ -86,27 +100,52 @@ class Permission(JsonSchemaMixin, Mongo, Tree, HasRoles, HasContext, HasName):
     else:
       return f"{self.context}_{self.name}"
 
+  @classmethod
+  async def get(cls, table, *args, **kwargs):
+    """Serves the permission lookups by context and name from the permission matrix"""
+    if args or kwargs.keys() != {"context", "name"}:
+      return await super().get(table, *args, **kwargs)
+
+    doc = await permission_matrix.document(table, kwargs["context"], kwargs["name"])
+    if not doc:
+      return None
+    permission = cls(**doc)
+    permission._table = table
+    return permission
+
   async def update(self, request: Request, consume: UpdatePermissionRequest) -> OkResult:
     """Updates the permission's roles"""
-    await super().update(request.app._models, **consume.to_dict())
+    try:
+      await super().update(request.app._models, **consume.to_dict())
+    finally:
+      permission_matrix.invalidate()
     return self
 
 @dataclass
-class Invitation(JsonSchemaMixin, Mongo, Tree, CanBeRemoved, HasEmail, HasName):
+class Invitation(HasAncestors, JsonSchemaMixin, Mongo, Tree, CanBeRemoved, HasEmail, HasName):
   """Preregistration of the user"""
   __x_schema__ = {"form": ["name", "email"]}
 
 @dataclass
-class User(JsonSchemaMixin, Mongo, Tree, CanBeAuthenticated, HasEmail, HasName):
+class User(HasAncestors, HashesPassword, JsonSchemaMixin, Mongo, Tree, HasLastLogin, CanBeAuthenticated, HasEmail, HasName):
   """Represents the user"""
   # __x_schema__ = {"form": ["email", "password"]}
   __indexer__ = "email"
   __exclude__ = ["password"]
 
-  def __post_init__(self):
-    super().__post_init__()
+  async def update(self, *args, **kwargs):
+    if kwargs.get("password") and kwargs["password"] != self.password:
+      kwargs["password"] = await password_hasher.hash(kwargs["password"])
+    try:
+      return await super().update(*args, **kwargs)
+    finally:
+      actor_cache.invalidate(self.slug)
 
-    self.password = Auth.secure(self.password)
+  async def delete(self, *args, **kwargs):
+    try:
+      return await super().delete(*args, **kwargs)
+    finally:
+      actor_cache.invalidate(self.slug)
 
   async def index(self, request: Request) -> OkResult:
     """Returns the user's data"""
@@ -114,7 +153,7 @@ class User(JsonSchemaMixin, Mongo, Tree, CanBeAuthenticated, HasEmail, HasName):
     return {"object": self.to_plain_dict(), "ancestors": ancestors}
 
 @dataclass
-class Project(JsonSchemaMixin, Mongo, Tree, ShouldBeResolved, HasRequester, CanBeRemovedWithFiles, IsCancelable, CanBeUpdated, ShouldEmitNewsAggregations, HasMessages, HasBacklog, HasFiles, HasStakeholders, HasPhases, HasTags, HasDepartment, HasAddress, HasDeadline, ShouldBeRegistrable, HasCode, HasDescription, HasName):
+class Project(HasAncestors, JsonSchemaMixin, Mongo, Tree, HasCounters, ShouldBeResolved, HasRequester, CanBeRemovedWithFiles, IsCancelable, CanBeUpdated, ShouldEmitNewsAggregations, HasMessages, HasActivity, HasBacklog, HasFiles, HasStakeholders, HasPhases, HasTags, HasDepartment, HasAddress, HasDeadline, ShouldBeRegistrable, HasCode, HasDescription, HasName):
   """Project"""
   __x_schema__ = {"form": ["name", "description", "code", "record", "deadline", "address", "tags", "requester", "department", "resolution"]}
   _encoder = yJSONEncoder
@@ -142,7 +181,7 @@ class Project(JsonSchemaMixin, Mongo, Tree, ShouldBeResolved, HasRequester, CanB
     return await super().update(request.app._models, **data)
 
 @dataclass
-class Record(JsonSchemaMixin, Mongo, Tree, ShouldBeResolved, HasRequester, CanBeRemovedWithFiles, IsCancelable, CanBeUpdated, ShouldEmitNewsAggregations, HasMessages, HasBacklog, HasFiles, HasStakeholders, HasPhases, HasTags, HasDepartment, HasAddress, HasDeadline, ShouldBeRegistrable, HasCode, HasDescription, HasName):
+class Record(HasAncestors, JsonSchemaMixin, Mongo, Tree, HasCounters, ShouldBeResolved, HasRequester, CanBeRemovedWithFiles, IsCancelable, CanBeUpdated, ShouldEmitNewsAggregations, HasMessages, HasActivity, HasBacklog, HasFiles, HasStakeholders, HasPhases, HasTags, HasDepartment, HasAddress, HasDeadline, ShouldBeRegistrable, HasCode, HasDescription, HasName):
   """Record"""
   __x_schema__ = {"form": ["name", "description", "code", "record", "deadline", "address", "tags", "requester", "departament", "resolution"]}
   _encoder = yJSONEncoder
@@ -170,11 +209,17 @@ class Record(JsonSchemaMixin, Mongo, Tree, ShouldBeResolved, HasRequester, CanBe
     return await super().update(request.app._models, **data)
 
 @dataclass
-class Phase(JsonSchemaMixin, Mongo, Tree, CanBeRemoved, ShouldBeFinished, HasName):
+class Phase(HasAncestors, JsonSchemaMixin, Mongo, Tree, CanBeRemoved, ShouldBeFinished, HasName):
   """Project's phase"""
 
+  async def remove(self, request: Request, actor: "User") -> OkResult:
+    """Removes the phase"""
+    result = await super().remove(request, actor)
+    await bump(self._table, self.path, phases = -1, finished = -1 if self.finished else 0)
+    return result
+
 @dataclass
-class Message(JsonSchemaMixin, Mongo, Tree, HasMessage, IsTemporalyMarked, FromUser):
+class Message(HasAncestors, JsonSchemaMixin, Mongo, Tree, HasMessage, IsTemporalyMarked, FromUser):
   """Chat message"""
 
   __indexer__ = "date"
@@ -188,7 +233,7 @@ class Message(JsonSchemaMixin, Mongo, Tree, HasMessage, IsTemporalyMarked, FromU
       return self.date.isoformat()
 
 @dataclass
-class Backlog(JsonSchemaMixin, Mongo, Tree, HasAspect, HasPath, FromUser, IsTemporalyMarked):
+class Backlog(HasAncestors, JsonSchemaMixin, Mongo, Tree, HasAspect, HasPath, FromUser, IsTemporalyMarked):
   """Backlog entry"""
 
   __indexer__ = "date"
@@ -202,11 +247,11 @@ class Backlog(JsonSchemaMixin, Mongo, Tree, HasAspect, HasPath, FromUser, IsTemp
       return self.date.isoformat()
 
 @dataclass
-class Requester(JsonSchemaMixin, Mongo, Tree, HasRequesterSubtype, HasRequesterType, HasNIF, HasPhone, HasEmail, HasName):
+class Requester(HasAncestors, JsonSchemaMixin, Mongo, Tree, HasRequesterSubtype, HasRequesterType, HasNIF, HasPhone, HasEmail, HasName):
   """Requester"""
   pass
 
 @dataclass
-class Department(JsonSchemaMixin, Mongo, Tree, HasName):
+class Department(HasAncestors, JsonSchemaMixin, Mongo, Tree, HasName):
   """Department"""
   pass
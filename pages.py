@@ -0,0 +1,53 @@
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from bson import ObjectId
+from bson.errors import InvalidId
+
+from sanic.exceptions import InvalidUsage
+
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+def page(request) -> Tuple[int, int]:
+  """Returns the optional skip and limit query arguments, 0 when they are missing or invalid"""
+  def argument(name: str) -> int:
+    try:
+      return max(int(request.args.get(name, 0)), 0)
+    except (TypeError, ValueError):
+      return 0
+
+  return argument("skip"), argument("limit")
+
+def page_size(limit: Any, config) -> int:
+  """Returns the requested page size bounded by the configuration"""
+  default = config.get("PAGE_SIZE", PAGE_SIZE)
+  try:
+    limit = int(limit) if limit else default
+  except (TypeError, ValueError):
+    limit = default
+  return min(max(limit, 1), config.get("MAX_PAGE_SIZE", MAX_PAGE_SIZE))
+
+def encode_cursor(doc: Dict[str, Any], field: str) -> str:
+  return f"{doc[field].isoformat()}_{doc['_id']}"
+
+def keyset_filter(field: str, cursor: Optional[str]) -> Dict[str, Any]:
+  """Returns the query that selects the documents older than the cursor in descending (field, _id) order"""
+  if not cursor:
+    return {}
+
+  try:
+    value, _, oid = cursor.rpartition("_")
+    value = datetime.fromisoformat(value)
+    oid = ObjectId(oid)
+  except (ValueError, InvalidId):
+    raise InvalidUsage(f"Invalid cursor: {cursor}")
+
+  return {"$or": [{field: {"$lt": value}}, {field: value, "_id": {"$lt": oid}}]}
+
+def keyset_page(request, field: str) -> Tuple[Dict[str, Any], int]:
+  """Returns the keyset filter and the page size from the before and limit query arguments"""
+  return keyset_filter(field, request.args.get("before")), page_size(request.args.get("limit"), request.app.config)
+
+def next_cursor(docs: List[Dict[str, Any]], field: str, limit: int) -> Optional[str]:
+  return encode_cursor(docs[-1], field) if len(docs) == limit else None
@@ -5,7 +5,6 @@ from dataclasses import dataclass, field
 from dataclasses_jsonschema import JsonSchemaMixin, JsonSchemaMeta
 
 from yrest.tree import Email, Password
-from yrest.auth import generate_password_hash
 
 @dataclass
 class UpdatePermissionRequest(JsonSchemaMixin):
@@ -30,7 +29,6 @@ class ChangePasswordRequest(JsonSchemaMixin):
   def __post_init__(self):
     if self.old == self.new:
       raise TypeError("The new password and the old one must be different")
-    self.new = generate_password_hash(self.new)
 
 @dataclass
 class UploadFilesRequest(JsonSchemaMixin):
@@ -42,6 +40,20 @@ class SearchRequest(JsonSchemaMixin):
   start_date: datetime = None
   end_date: datetime = None
 
+@dataclass
+class ActivityRequest(JsonSchemaMixin):
+  start_date: datetime = None
+  end_date: datetime = None
+  granularity: str = "day"
+
+  def __post_init__(self):
+    if self.granularity not in ("hour", "day"):
+      raise TypeError("The granularity must be hour or day")
+    if self.start_date and isinstance(self.start_date, str):
+      self.start_date = datetime.fromisoformat(self.start_date)
+    if self.end_date and isinstance(self.end_date, str):
+      self.end_date = datetime.fromisoformat(self.end_date)
+
 @dataclass
 class GetFileRequest(JsonSchemaMixin):
   filename: str
@@ -0,0 +1,45 @@
+from asyncio import Semaphore, get_event_loop
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+from yrest.auth import generate_password_hash, check_password_hash
+
+class PasswordHasher:
+  """Runs the deliberately slow password key derivation in a bounded process pool"""
+  def __init__(self, workers: int = 2, queue_size: int = 64):
+    self.workers = workers
+    self.queue_size = queue_size
+
+    self._pool = None
+    self._limit = None
+
+  def configure(self, config):
+    self.workers = config.get("PASSWORD_WORKERS", self.workers)
+    self.queue_size = config.get("PASSWORD_QUEUE_SIZE", self.queue_size)
+
+  async def _run(self, function, *args):
+    if self._pool is None:
+      self._pool = ProcessPoolExecutor(max_workers = self.workers)
+      self._limit = Semaphore(self.queue_size)
+
+    async with self._limit:
+      return await get_event_loop().run_in_executor(self._pool, function, *args)
+
+  async def hash(self, password: str) -> str:
+    return await self._run(generate_password_hash, password)
+
+  async def check(self, password_hash: Optional[str], password: Optional[str]) -> bool:
+    """Tells if password matches the hash, False when either is missing or the hash is malformed"""
+    if not password_hash or not password:
+      return False
+    try:
+      return await self._run(check_password_hash, password_hash, password)
+    except ValueError:
+      return False
+
+  def close(self):
+    if self._pool:
+      self._pool.shutdown(wait = False)
+      self._pool = None
+
+password_hasher = PasswordHasher()
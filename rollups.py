@@ -0,0 +1,44 @@
+from collections import defaultdict
+from datetime import datetime
+from typing import Any, Dict, Iterable, List
+
+from pymongo import UpdateOne
+
+from urls import url_chain
+
+GRANULARITIES = ("hour", "day")
+
+def truncate(date: datetime, granularity: str) -> datetime:
+  date = date.replace(minute = 0, second = 0, microsecond = 0)
+  return date.replace(hour = 0) if granularity == "day" else date
+
+def rollup_id(node: str, granularity: str, bucket: datetime) -> str:
+  return f"{node}|{granularity}|{bucket.isoformat()}"
+
+def rollup_updates(entries: Iterable[Dict[str, Any]]) -> List[UpdateOne]:
+  """Returns the rollups' upserts of a batch of backlog entries"""
+  amounts = defaultdict(lambda: defaultdict(int))
+  for entry in entries:
+    for granularity in GRANULARITIES:
+      bucket = truncate(entry["date"], granularity)
+      for node in url_chain(entry["runned_path"]):
+        amounts[(node, granularity, bucket)][entry["aspect"]] += 1
+
+  return [rollup_upsert(node, granularity, bucket, aspects) for (node, granularity, bucket), aspects in amounts.items()]
+
+def rollup_upsert(node: str, granularity: str, bucket: datetime, aspects: Dict[str, int]) -> UpdateOne:
+  increments = {f"aspects.{aspect}": amount for aspect, amount in aspects.items()}
+  increments["total"] = sum(aspects.values())
+  return UpdateOne({"_id": rollup_id(node, granularity, bucket)}, {"$setOnInsert": {"node": node, "granularity": granularity, "bucket": bucket}, "$inc": increments}, upsert = True)
+
+async def activity(collection, node: str, start: datetime, end: datetime, granularity: str) -> Dict[str, Any]:
+  """Returns the node's activity series and totals between start and end"""
+  query = {"node": node, "granularity": granularity, "bucket": {"$gte": truncate(start, granularity), "$lte": end}}
+  series = []
+  totals = defaultdict(int)
+  async for doc in collection.find(query).sort("bucket", 1):
+    series.append({"bucket": doc["bucket"].isoformat(), "total": doc["total"], "aspects": doc.get("aspects", {})})
+    for aspect, amount in doc.get("aspects", {}).items():
+      totals[aspect] += amount
+
+  return {"series": series, "aspects": dict(totals), "total": sum(totals.values())}
@@ -0,0 +1,231 @@
+from asyncio import Lock, create_task, gather, shield
+from collections import OrderedDict
+from datetime import datetime
+from json import loads
+from time import monotonic
+from typing import Any, Dict, Optional, Tuple
+
+from sanic.log import logger
+
+from encoding import dumps
+from search_index import SearchIndex
+from urls import url_chain
+
+SEARCH_FIELDS = ["name", "description", "code", "address", "areas", "themes", "tags", "filename"]
+INDEXED_TYPES = ["Group", "Project", "Record", "Phase"]
+# Dispatched members that change indexed documents or files, the rest only read
+INDEXED_MEMBERS = {"update", "upload_files", "finish", "cancel", "reopen", "remove"}
+
+def date_range(consume):
+  """Returns the start and end datetimes of the search request's dates"""
+  if consume.start_date:
+    return f"{consume.start_date}T00:00:00", f"{consume.end_date or consume.start_date}T23:59:59"
+  return None, None
+
+def search_key(consume) -> Tuple[Optional[str], Optional[str], Optional[str]]:
+  """Returns the normalized search text and date range of the search request"""
+  text = " ".join(consume.search.lower().split()) if consume.search else None
+  return (text or None, *date_range(consume))
+
+def es_query(consume) -> Dict[str, Any]:
+  """Returns the elasticsearch query of the search request"""
+  if consume.search:
+    search_query = {
+      "multi_match": {
+        "fields": SEARCH_FIELDS,
+        "query": consume.search,
+        "fuzziness": "AUTO"
+      }
+    }
+  else:
+    search_query = None
+
+  start, end = date_range(consume)
+  date_query = {"range": {"record": {"gte": start, "lte": end}}} if start else None
+
+  if search_query and date_query:
+    return {"query": {"bool": {"must": search_query, "filter": [ date_query ]}}}
+  elif search_query:
+    return {"query": search_query}
+  else:
+    return {"query": date_query}
+
+class ElasticsearchBackend:
+  """Searches the gd.gd and gd.fs.files elasticsearch indexes"""
+  def __init__(self, es, index: str):
+    self._es = es
+    self.index = index
+
+  async def search(self, consume) -> Dict[str, Any]:
+    result = await self._es.search(index = self.index, body = es_query(consume))
+    return result["hits"]
+
+  def touched(self, url: str):
+    """Elasticsearch is fed from the database, nothing to do"""
+
+  async def start(self):
+    pass
+
+  async def close(self):
+    pass
+
+class LocalBackend:
+  """Searches an in-process index kept in sync with the tree writes"""
+  def __init__(self, table, index: SearchIndex, size: int = 10):
+    self._table = table
+    self._files = table.database["fs.files"]
+    self.index = index
+    self.size = size
+    self.tree_index = f"{table.database.name}.{table.name}"
+    self.files_index = f"{table.database.name}.fs.files"
+
+    self._lock = Lock()
+    self._tasks = set()
+
+  @classmethod
+  def from_config(cls, table, config):
+    index = SearchIndex(config.get("SEARCH_INDEX_PATH", "search_index"), flush_size = config.get("SEARCH_FLUSH_SIZE", 1000), max_segments = config.get("SEARCH_MAX_SEGMENTS", 8))
+    return cls(table, index, size = config.get("SEARCH_SIZE", 10))
+
+  async def start(self):
+    """Rebuilds an index that was never completed and syncs the writes whose refresh was interrupted"""
+    if not self.index.complete:
+      await self.rebuild()
+    for url in sorted(self.index.pending, key = len, reverse = True):
+      await self.refresh(url)
+
+  async def search(self, consume) -> Dict[str, Any]:
+    start, end = date_range(consume)
+    return self.index.search(consume.search, datetime.fromisoformat(start) if start else None, datetime.fromisoformat(end) if end else None, self.size)
+
+  async def rebuild(self):
+    """Indexes every searchable document and file"""
+    async with self._lock:
+      self.index.clear()
+      async for doc in self._table.find({"type": {"$in": INDEXED_TYPES}}):
+        self._add_node(doc, log = False)
+      async for doc in self._files.find({}):
+        self._add_file(doc, log = False)
+      self.index.mark_complete()
+
+  def touched(self, url: str):
+    """Brings the index up to date with a write at url in the background, where the journal is committed"""
+    self.index.touch(url)
+    task = create_task(self.refresh(url))
+    self._tasks.add(task)
+    task.add_done_callback(self._tasks.discard)
+
+  async def refresh(self, url: str):
+    """Reindexes the deepest existing node of url with its new children and files, dropping the removed ones"""
+    async with self._lock:
+      try:
+        await self.index.commit()
+        for node_url in url_chain(url):
+          doc = await self._table.find_one(self._node_query(node_url))
+          if not doc:
+            self.index.delete_tree(node_url)
+            continue
+
+          if doc["type"] in INDEXED_TYPES:
+            self._add_node(doc)
+          async for child in self._table.find({"path": node_url, "type": {"$in": INDEXED_TYPES}}):
+            if self._node_key(child) not in self.index:
+              self._add_node(child)
+          async for file in self._files.find({"metadata.parent": node_url}):
+            if file["filename"] not in self.index:
+              self._add_file(file)
+          break
+        self.index.synced(url)
+        await self.index.commit()
+      except Exception as e:
+        logger.error(f"Can't refresh the search index at {url}: {e}")
+
+  async def close(self):
+    if self._tasks:
+      await gather(*self._tasks, return_exceptions = True)
+    async with self._lock:
+      self.index.close()
+
+  @staticmethod
+  def _node_query(url: str) -> Dict[str, Any]:
+    if url == "/":
+      return {"path": ""}
+    path, slug = url.rsplit("/", 1)
+    return {"path": path or "/", "slug": slug}
+
+  @staticmethod
+  def _node_key(doc: Dict[str, Any]) -> str:
+    return "/" if doc["path"] == "" else f"{doc['path'].rstrip('/')}/{doc['slug']}"
+
+  @staticmethod
+  def _source(doc: Dict[str, Any]) -> Dict[str, Any]:
+    return loads(dumps({key: value for key, value in doc.items() if key != "_id"}))
+
+  def _add_node(self, doc: Dict[str, Any], log: bool = True):
+    texts = []
+    for field in SEARCH_FIELDS:
+      value = doc.get(field) or []
+      texts.extend(value if isinstance(value, list) else [value])
+    self.index.add(self._node_key(doc), str(doc["_id"]), self.tree_index, self._source(doc), doc.get("record"), texts, log = log)
+
+  def _add_file(self, doc: Dict[str, Any], log: bool = True):
+    self.index.add(doc["filename"], str(doc["_id"]), self.files_index, self._source(doc), None, [doc["filename"]], log = log)
+
+class CachedSearch:
+  """Caches the results of a search backend and collapses identical in-flight queries"""
+  def __init__(self, backend, max_size: int = 256, ttl: float = 30.0):
+    self.backend = backend
+    self.max_size = max_size
+    self.ttl = ttl
+
+    self._entries = OrderedDict()
+    self._pending = {}
+    self._generation = 0
+
+  @classmethod
+  def from_config(cls, backend, config):
+    return cls(backend, max_size = config.get("SEARCH_CACHE_SIZE", 256), ttl = config.get("SEARCH_CACHE_TTL", 30.0))
+
+  async def search(self, consume) -> Dict[str, Any]:
+    key = search_key(consume)
+    entry = self._entries.get(key)
+    if entry:
+      expires, result = entry
+      if expires >= monotonic():
+        self._entries.move_to_end(key)
+        return result
+      del self._entries[key]
+
+    task = self._pending.get(key)
+    if task is None:
+      task = create_task(self._fetch(key, consume, self._generation))
+      self._pending[key] = task
+      task.add_done_callback(lambda task, key = key: self._forget(key, task))
+
+    return await shield(task)
+
+  async def _fetch(self, key, consume, generation: int) -> Dict[str, Any]:
+    result = await self.backend.search(consume)
+    if generation == self._generation:
+      self._entries[key] = (monotonic() + self.ttl, result)
+      while len(self._entries) > self.max_size:
+        self._entries.popitem(last = False)
+    return result
+
+  def _forget(self, key, task):
+    if self._pending.get(key) is task:
+      del self._pending[key]
+
+  def touched(self, url: str):
+    """Forgets every cached result, any of them could include the changed documents"""
+    self._generation += 1
+    self._entries.clear()
+    self._pending.clear()
+    self.backend.touched(url)
+
+  async def start(self):
+    await self.backend.start()
+
+  async def close(self):
+    self._entries.clear()
+    await self.backend.close()
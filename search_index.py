@@ -0,0 +1,483 @@
+from asyncio import Lock, get_event_loop
+from bisect import bisect_left, insort
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta, timezone
+from json import dumps, loads
+from math import log, isnan
+from mmap import mmap, ACCESS_READ
+from os import fsync, makedirs, remove, replace
+from os.path import exists, join
+from re import compile as re_compile
+from struct import Struct
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from unicodedata import combining, normalize
+
+TOKEN_RE = re_compile(r"\w+")
+
+HEADER = Struct("<4sIII7Q")
+MAGIC = b"GDSX"
+VERSION = 1
+OFFSET = Struct("<Q")
+POSTING = Struct("<II")
+DATE = Struct("<d")
+
+EPOCH = datetime(1970, 1, 1)
+
+def to_timestamp(date: datetime) -> float:
+  """Returns the seconds since the epoch of a naive UTC or an aware datetime"""
+  if date.tzinfo:
+    date = date.astimezone(timezone.utc).replace(tzinfo = None)
+  return (date - EPOCH).total_seconds()
+
+def from_timestamp(seconds: float) -> datetime:
+  return EPOCH + timedelta(seconds = seconds)
+
+def tokenize(text: str) -> List[str]:
+  """Returns the lowercased, accent free words of text"""
+  text = "".join(char for char in normalize("NFKD", text) if not combining(char))
+  return TOKEN_RE.findall(text.lower())
+
+def fuzziness(term: str) -> int:
+  """Returns the allowed edit distance like elasticsearch's AUTO fuzziness"""
+  return 0 if len(term) <= 2 else 1 if len(term) <= 5 else 2
+
+def distance(a: str, b: str, limit: int) -> int:
+  """Returns the Levenshtein distance between a and b or limit + 1 if it exceeds limit"""
+  if abs(len(a) - len(b)) > limit:
+    return limit + 1
+
+  previous = list(range(len(b) + 1))
+  for i, char_a in enumerate(a, 1):
+    current = [i]
+    for j, char_b in enumerate(b, 1):
+      current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+    if min(current) > limit:
+      return limit + 1
+    previous = current
+
+  return previous[-1]
+
+class Segment:
+  """Immutable index segment read through mmap
+
+  Layout: header, term offsets, term blob, postings offsets, postings (docnum, frequency), doc offsets, doc blob (JSON) and record dates (float timestamps, NaN when missing)"""
+  def __init__(self, path: str):
+    self.path = path
+    self._file = open(path, "rb")
+    self._map = mmap(self._file.fileno(), 0, access = ACCESS_READ)
+
+    magic, version, self.ndocs, self.nterms, *sections = HEADER.unpack_from(self._map, 0)
+    if magic != MAGIC or version != VERSION:
+      raise ValueError(f"{path} is not a search segment")
+    self._term_offsets, self._terms, self._post_offsets, self._postings, self._doc_offsets, self._docs, self._dates = sections
+
+    self._vocabulary = None
+
+  @staticmethod
+  def write(path: str, docs: List[Dict[str, Any]]):
+    """Writes the docs, each with key, id, index, source, record and terms, as a segment"""
+    postings = defaultdict(list)
+    for docnum, doc in enumerate(docs):
+      for term, frequency in doc["terms"].items():
+        postings[term].append((docnum, frequency))
+    terms = sorted(postings)
+
+    term_blob = bytearray()
+    term_offsets = [0]
+    postings_blob = bytearray()
+    post_offsets = [0]
+    for term in terms:
+      term_blob += term.encode("UTF-8")
+      term_offsets.append(len(term_blob))
+      for posting in postings[term]:
+        postings_blob += POSTING.pack(*posting)
+      post_offsets.append(len(postings_blob))
+
+    doc_blob = bytearray()
+    doc_offsets = [0]
+    dates = bytearray()
+    for doc in docs:
+      doc_blob += dumps({"key": doc["key"], "id": doc["id"], "index": doc["index"], "source": doc["source"]}).encode("UTF-8")
+      doc_offsets.append(len(doc_blob))
+      dates += DATE.pack(to_timestamp(doc["record"]) if doc["record"] else float("nan"))
+
+    sections = []
+    body = bytearray()
+    for blob in (b"".join(OFFSET.pack(offset) for offset in term_offsets), term_blob, b"".join(OFFSET.pack(offset) for offset in post_offsets), postings_blob,
+      b"".join(OFFSET.pack(offset) for offset in doc_offsets), doc_blob, dates):
+      sections.append(HEADER.size + len(body))
+      body += blob
+
+    with open(f"{path}.tmp", "wb") as f:
+      f.write(HEADER.pack(MAGIC, VERSION, len(docs), len(terms), *sections))
+      f.write(body)
+    replace(f"{path}.tmp", path)
+
+  def close(self):
+    self._map.close()
+    self._file.close()
+
+  def _offset(self, section: int, index: int) -> int:
+    return OFFSET.unpack_from(self._map, section + index * OFFSET.size)[0]
+
+  def term(self, termnum: int) -> str:
+    start, end = self._offset(self._term_offsets, termnum), self._offset(self._term_offsets, termnum + 1)
+    return self._map[self._terms + start:self._terms + end].decode("UTF-8")
+
+  def find(self, term: str) -> Optional[int]:
+    """Returns the term's number by binary search over the sorted terms"""
+    low, high = 0, self.nterms
+    while low < high:
+      middle = (low + high) // 2
+      current = self.term(middle)
+      if current == term:
+        return middle
+      if current < term:
+        low = middle + 1
+      else:
+        high = middle
+    return None
+
+  @property
+  def vocabulary(self) -> Dict[int, List[Tuple[str, int]]]:
+    """Returns the terms grouped by length to narrow the fuzzy matching"""
+    if self._vocabulary is None:
+      self._vocabulary = defaultdict(list)
+      for termnum in range(self.nterms):
+        term = self.term(termnum)
+        self._vocabulary[len(term)].append((term, termnum))
+    return self._vocabulary
+
+  def postings(self, termnum: int) -> Iterable[Tuple[int, int]]:
+    start, end = self._offset(self._post_offsets, termnum), self._offset(self._post_offsets, termnum + 1)
+    return POSTING.iter_unpack(self._map[self._postings + start:self._postings + end])
+
+  def doc(self, docnum: int) -> Dict[str, Any]:
+    start, end = self._offset(self._doc_offsets, docnum), self._offset(self._doc_offsets, docnum + 1)
+    return loads(self._map[self._docs + start:self._docs + end])
+
+  def record(self, docnum: int) -> Optional[float]:
+    value = DATE.unpack_from(self._map, self._dates + docnum * DATE.size)[0]
+    return None if isnan(value) else value
+
+class SearchIndex:
+  """Inverted index persisted as mmap'ed segments plus an in-memory segment for the latest writes
+
+  Every write is buffered for the journal, which commit appends and syncs off the loop, that is replayed on load and truncated once the writes are in a segment"""
+  def __init__(self, path: str, flush_size: int = 1000, max_segments: int = 8):
+    self.path = path
+    self.flush_size = flush_size
+    self.max_segments = max_segments
+    self.complete = False
+    self.pending = set()
+
+    self._segments = {}
+    self._deleted = defaultdict(set)
+    self._next = 1
+    self._memory = {}
+    self._keys = {}
+    self._sorted = []
+    self._buffer = []
+    self._commit_lock = Lock()
+
+    makedirs(path, exist_ok = True)
+    self._load()
+    self._journal = open(self._journal_path(), "a")
+
+  def __len__(self) -> int:
+    return len(self._keys) + len(self._memory)
+
+  def __contains__(self, key: str) -> bool:
+    return key in self._memory or key in self._keys
+
+  def _manifest_path(self) -> str:
+    return join(self.path, "manifest.json")
+
+  def _journal_path(self) -> str:
+    return join(self.path, "journal.jsonl")
+
+  def _log(self, entry: Dict[str, Any]):
+    self._buffer.append(dumps(entry) + "\n")
+
+  def _write(self, lines: List[str]):
+    self._journal.write("".join(lines))
+    self._journal.flush()
+    fsync(self._journal.fileno())
+
+  async def commit(self):
+    """Appends the buffered writes to the journal and syncs it in an executor, one sync for all of them"""
+    async with self._commit_lock:
+      if self._buffer:
+        lines, self._buffer = self._buffer, []
+        await get_event_loop().run_in_executor(None, self._write, lines)
+
+  def _replay(self):
+    if not exists(self._journal_path()):
+      return
+
+    with open(self._journal_path()) as f:
+      for line in f:
+        try:
+          entry = loads(line)
+        except ValueError:
+          break
+        if entry["op"] == "add":
+          entry["record"] = datetime.fromisoformat(entry["record"]) if entry["record"] else None
+          self._add(entry["key"], entry["id"], entry["index"], entry["source"], entry["record"], Counter(entry["terms"]))
+        elif entry["op"] == "delete":
+          self._delete(entry["key"])
+        elif entry["op"] == "touch":
+          self.pending.add(entry["url"])
+        elif entry["op"] == "synced":
+          self.pending.discard(entry["url"])
+
+  def _load(self):
+    if not exists(self._manifest_path()):
+      self._replay()
+      return
+
+    with open(self._manifest_path()) as f:
+      manifest = loads(f.read())
+    self._next = manifest["next"]
+    self.complete = manifest.get("complete", True)
+    self.pending = set(manifest.get("pending", []))
+    for name in manifest["segments"]:
+      self._segments[name] = Segment(join(self.path, name))
+      self._deleted[name] = set(manifest["deleted"].get(name, []))
+
+    for name, segment in self._segments.items():
+      for docnum in range(segment.ndocs):
+        if docnum not in self._deleted[name]:
+          self._keys[segment.doc(docnum)["key"]] = (name, docnum)
+    self._sorted = sorted(self._keys)
+
+    self._replay()
+
+  def _save_manifest(self):
+    """Persists the segments and tombstones, the journal is truncated as the manifest includes its writes"""
+    manifest = {"next": self._next, "complete": self.complete, "pending": sorted(self.pending), "segments": list(self._segments), "deleted": {name: sorted(docnums) for name, docnums in self._deleted.items() if docnums}}
+    with open(f"{self._manifest_path()}.tmp", "w") as f:
+      f.write(dumps(manifest))
+      f.flush()
+      fsync(f.fileno())
+    replace(f"{self._manifest_path()}.tmp", self._manifest_path())
+    if self._memory:
+      return
+    self._buffer = []
+    self._journal.close()
+    self._journal = open(self._journal_path(), "w")
+
+  def add(self, key: str, id: str, index: str, source: Dict[str, Any], record: Optional[datetime], texts: Iterable[str], log: bool = True):
+    """Indexes the document replacing any previous version with the same key, journaled unless log is False"""
+    terms = Counter(term for text in texts for term in tokenize(text))
+    if log:
+      self._log({"op": "add", "key": key, "id": id, "index": index, "source": source, "record": record.isoformat() if record else None, "terms": terms})
+    self._add(key, id, index, source, record, terms)
+    if len(self._memory) >= self.flush_size:
+      self.flush()
+
+  def _add(self, key: str, id: str, index: str, source: Dict[str, Any], record: Optional[datetime], terms: Counter):
+    if not self._delete(key):
+      insort(self._sorted, key)
+    self._memory[key] = {"key": key, "id": id, "index": index, "source": source, "record": record, "terms": terms}
+
+  def delete(self, key: str):
+    if key in self:
+      self._log({"op": "delete", "key": key})
+      self._delete(key)
+
+  def _delete(self, key: str) -> bool:
+    """Drops the document, True when it was indexed"""
+    found = self._memory.pop(key, None) is not None
+    location = self._keys.pop(key, None)
+    if location:
+      self._deleted[location[0]].add(location[1])
+      found = True
+    if found:
+      del self._sorted[bisect_left(self._sorted, key)]
+    return found
+
+  def under(self, url: str) -> List[str]:
+    """Returns the keys at url and under it from the sorted keys"""
+    keys = [url] if url in self else []
+    prefix = url.rstrip("/") + "/"
+    position = bisect_left(self._sorted, prefix)
+    while position < len(self._sorted) and self._sorted[position].startswith(prefix):
+      keys.append(self._sorted[position])
+      position += 1
+    return keys
+
+  def delete_tree(self, url: str):
+    """Deletes the documents at url and under it"""
+    for key in self.under(url):
+      self.delete(key)
+
+  def touch(self, url: str):
+    """Records that the documents at url must be synced, until synced is called"""
+    self.pending.add(url)
+    self._log({"op": "touch", "url": url})
+
+  def synced(self, url: str):
+    self.pending.discard(url)
+    self._log({"op": "synced", "url": url})
+
+  def clear(self):
+    """Deletes every document and marks the index as incomplete until it's marked complete again"""
+    old = self._segments
+    self._segments = {}
+    self._deleted = defaultdict(set)
+    self._keys = {}
+    self._sorted = []
+    self._memory = {}
+    self.pending = set()
+    self.complete = False
+    self._save_manifest()
+
+    for name, segment in old.items():
+      segment.close()
+      remove(join(self.path, name))
+
+  def mark_complete(self):
+    self.flush()
+    self.complete = True
+    self._save_manifest()
+
+  def keys(self) -> List[str]:
+    return list(self._keys) + list(self._memory)
+
+  def flush(self):
+    """Writes the in-memory documents as a new segment and compacts when there are too many"""
+    if self._memory:
+      name = f"segment-{self._next:06d}.seg"
+      self._next += 1
+      docs = list(self._memory.values())
+      Segment.write(join(self.path, name), docs)
+      self._segments[name] = Segment(join(self.path, name))
+      for docnum, doc in enumerate(docs):
+        self._keys[doc["key"]] = (name, docnum)
+      self._memory = {}
+
+    if len(self._segments) > self.max_segments:
+      self.compact()
+    else:
+      self._save_manifest()
+
+  def compact(self):
+    """Merges the live documents of every segment into one"""
+    docs = []
+    positions = {}
+    for name, docnum in self._keys.values():
+      segment = self._segments[name]
+      doc = segment.doc(docnum)
+      record = segment.record(docnum)
+      doc["record"] = from_timestamp(record) if record is not None else None
+      doc["terms"] = Counter()
+      positions[(name, docnum)] = len(docs)
+      docs.append(doc)
+
+    for name, segment in self._segments.items():
+      for termnum in range(segment.nterms):
+        term = segment.term(termnum)
+        for docnum, frequency in segment.postings(termnum):
+          position = positions.get((name, docnum))
+          if position is not None:
+            docs[position]["terms"][term] = frequency
+
+    old = self._segments
+    self._segments = {}
+    self._deleted = defaultdict(set)
+    self._keys = {}
+    if docs:
+      name = f"segment-{self._next:06d}.seg"
+      self._next += 1
+      Segment.write(join(self.path, name), docs)
+      self._segments[name] = Segment(join(self.path, name))
+      self._keys = {doc["key"]: (name, docnum) for docnum, doc in enumerate(docs)}
+    self._save_manifest()
+
+    for name, segment in old.items():
+      segment.close()
+      remove(join(self.path, name))
+
+  def close(self):
+    self.flush()
+    if self._buffer:
+      self._write(self._buffer)
+      self._buffer = []
+    self._journal.close()
+    for segment in self._segments.values():
+      segment.close()
+
+  def search(self, text: Optional[str], start: Optional[datetime] = None, end: Optional[datetime] = None, size: int = 10) -> Dict[str, Any]:
+    """Returns the best matches of text's terms, allowing typos, with their record between start and end"""
+    start = to_timestamp(start) if start else None
+    end = to_timestamp(end) if end else None
+
+    def in_range(record: Optional[float]) -> bool:
+      if start is None and end is None:
+        return True
+      return record is not None and (start is None or record >= start) and (end is None or record <= end)
+
+    scores = defaultdict(float)
+    total = max(len(self), 1)
+    for query in tokenize(text or ""):
+      matches = self._matches(query)
+      frequency = sum(len(postings) for _, postings in matches)
+      idf = log(1 + (total - frequency + 0.5) / (frequency + 0.5))
+      for weight, postings in matches:
+        for location, tf in postings:
+          scores[location] += weight * idf * tf / (tf + 1.2)
+
+    if not text:
+      for key, (name, docnum) in self._keys.items():
+        scores[(name, docnum)] = 1.0
+      for key in self._memory:
+        scores[(None, key)] = 1.0
+
+    hits = []
+    for (name, position), score in scores.items():
+      if name is None:
+        doc = self._memory[position]
+        record = to_timestamp(doc["record"]) if doc["record"] else None
+      else:
+        doc = None
+        record = self._segments[name].record(position)
+      if in_range(record):
+        hits.append((score, name, position, doc))
+
+    hits.sort(key = lambda hit: hit[0], reverse = True)
+    result = []
+    for score, name, position, doc in hits[:size]:
+      doc = doc or self._segments[name].doc(position)
+      result.append({"_index": doc["index"], "_id": doc["id"], "_score": score, "_source": doc["source"]})
+
+    return {"total": len(hits), "max_score": hits[0][0] if hits else None, "hits": result}
+
+  def _matches(self, query: str) -> List[Tuple[float, List[Tuple[Tuple[Optional[str], Any], int]]]]:
+    """Returns the weighted postings of the terms within the query's fuzziness"""
+    limit = fuzziness(query)
+    matches = []
+    for name, segment in self._segments.items():
+      deleted = self._deleted[name]
+      if limit:
+        candidates = [(termnum, distance(query, term, limit)) for length in range(len(query) - limit, len(query) + limit + 1) for term, termnum in segment.vocabulary.get(length, [])]
+      else:
+        termnum = segment.find(query)
+        candidates = [(termnum, 0)] if termnum is not None else []
+
+      for termnum, edits in candidates:
+        if edits <= limit:
+          postings = [((name, docnum), tf) for docnum, tf in segment.postings(termnum) if docnum not in deleted]
+          matches.append((1.0 / (1 + edits), postings))
+
+    memory = defaultdict(list)
+    for key, doc in self._memory.items():
+      for term, tf in doc["terms"].items():
+        if abs(len(term) - len(query)) <= limit:
+          memory[term].append(((None, key), tf))
+    for term, postings in memory.items():
+      edits = 0 if term == query else distance(query, term, limit)
+      if edits <= limit:
+        matches.append((1.0 / (1 + edits), postings))
+
+    return matches
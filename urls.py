@@ -0,0 +1,6 @@
+from typing import List
+
+def url_chain(url: str) -> List[str]:
+  """Returns the url followed by all its parents' urls up to the root"""
+  parts = [part for part in url.split("/") if part]
+  return ["/" + "/".join(parts[:index]) for index in range(len(parts), -1, -1)]